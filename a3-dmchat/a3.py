@@ -24,7 +24,8 @@ from tkinter import ttk, simpledialog, messagebox
 from ds_messenger import DirectMessenger
 from notebook import Notebook, NotebookFileError, IncorrectNotebookError
 
-REFRESH_INTERVAL_MS = 5000  # auto-poll every 5 seconds
+REFRESH_INTERVAL_MS = 5000  # auto-poll every 5 seconds (servers without push)
+PUSH_CHECK_MS = 200         # drain locally pushed messages (no network traffic)
 
 class ChatApp(tk.Tk):
     def __init__(self):
@@ -58,6 +59,14 @@ class ChatApp(tk.Tk):
             self.dm = None
             self.online = False
 
+        # 3b) Prefer server push; fall back to polling if it is unsupported
+        self.push = False
+        if self.online:
+            try:
+                self.push = self.dm.subscribe()
+            except Exception:
+                self.push = False
+
         # 4) Build and populate the UI
         self._build_widgets()
         self._populate_contacts()
@@ -186,11 +195,24 @@ class ChatApp(tk.Tk):
             self.tree.insert("", "end", iid=contact, text=contact)
 
     def _refresh(self):
-        # Attempt to fetch unread messages from the server
+        # A reconnect (also one made by a retried send) renews the
+        # subscription; fall back to polling if that did not work
+        self.push = self.dm.subscribed
+        # Collect pushed messages, or poll the server for unread ones
         try:
-            new_msgs = self.dm.retrieve_new()
+            if self.push:
+                new_msgs = self.dm.retrieve_pushed()
+            else:
+                new_msgs = self.dm.retrieve_new()
         except Exception:
-            # On any error, skip this refresh cycle
+            # The connection dropped: resume the session on a new one
+            # and try again next cycle
+            try:
+                self.dm.reconnect()   # renews the subscription
+                self.push = self.dm.subscribed or self.dm.subscribe()
+            except Exception:
+                pass
+            self._schedule_refresh()
             return
         # Process each incoming message
         for dm in new_msgs:
@@ -211,7 +233,8 @@ class ChatApp(tk.Tk):
 
     def _schedule_refresh(self):
         # Call _refresh again after the defined interval
-        self.after(REFRESH_INTERVAL_MS, self._refresh)
+        interval = PUSH_CHECK_MS if self.push else REFRESH_INTERVAL_MS
+        self.after(interval, self._refresh)
 
     def _on_close(self):
         # Build the path for the notebook file
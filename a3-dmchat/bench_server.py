@@ -0,0 +1,370 @@
+# bench_server.py
+
+# Alex Madas
+# Madasa
+# 39847840
+
+"""
+bench_server.py
+
+Load generator and benchmark for the DSU server.
+
+For every store size it starts a fresh DSUServer on a local port with a
+temporary store preloaded with that many messages, then runs N simulated
+DirectMessenger clients, each doing a weighted random mix of
+authenticate / send / fetch-unread / fetch-all. It reports throughput
+and p50/p95/p99 latency per operation and can save everything as JSON
+so runs can be compared.
+
+With --compress the clients negotiate zlib compression. --compression
+also measures, for fetch responses of typical history sizes, the bytes
+compression saves and the CPU time it costs on each side.
+
+With --processes N the server runs as N worker processes (a DSUCluster,
+which needs --backend sqlite).
+
+--backend memory runs the server on the in-memory store, an upper bound
+on what the protocol and server code can do without storage I/O.
+
+With --binary the clients negotiate the binary encoding. --codec
+compares the two encodings head to head: requests encoded and fetch
+responses decoded per second, and their sizes.
+
+Example:
+    python bench_server.py --clients 16 --ops 200 --sizes 0,10000,100000 \\
+        --mix auth=1,send=6,unread=2,all=1 --output results.json
+    python bench_server.py --compression 10,100,1000,10000 --sizes ''
+    python bench_server.py --codec 20000 --sizes 0 --binary
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import server
+from ds_messenger import DirectMessenger
+import ds_protocol
+from ds_protocol import compress_frame, decompress_frame
+from ds_storage import BACKENDS, WireMessage, encode_messages_response
+
+DEFAULT_MIX = {'auth': 1, 'send': 6, 'unread': 2, 'all': 1}
+PASSWORD = 'bench'
+WORDS = ('hey', 'are', 'you', 'coming', 'to', 'lab', 'today', 'the', 'project',
+         'is', 'due', 'friday', 'lol', 'ok', 'see', 'you', 'there', 'thanks')
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    """
+    Parse "auth=1,send=6,unread=2,all=1" into a weight per operation.
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation in mix: {name}")
+        mix[name] = int(weight)
+    return mix
+
+
+def percentiles(samples: List[float]) -> dict:
+    """
+    Summarize latencies (seconds) as milliseconds.
+    """
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': pick(50),
+        'p95_ms': pick(95),
+        'p99_ms': pick(99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def preload(store_dir: str, backend: str, users: int, messages: int) -> None:
+    """
+    Create the benchmark users and `messages` messages spread between
+    them, straight through the storage engine (no server involved).
+    """
+    store = BACKENDS[backend](store_dir)
+    store.open()
+    names = [f'bench{i}' for i in range(users)]
+    for name in names:
+        store.create_user(name, PASSWORD)
+    rng = random.Random(0)
+    pairs = [(rng.choice(names), rng.choice(names)) for _ in range(messages)]
+    # many writers at once so the group commit can batch them
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        list(pool.map(lambda p: store.add_message('preloaded message', *p), pairs))
+    store.close()
+
+
+def run_client(address: str, index: int, users: int, ops: int,
+               mix: Dict[str, int], seed: int,
+               compress: bool = False, binary: bool = False) -> Dict[str, List[float]]:
+    """
+    One simulated client. Returns the latencies of each operation type.
+    """
+    rng = random.Random(seed * 1000 + index)
+    name = f'bench{index % users}'
+    kinds = [k for k in mix if mix[k] > 0]
+    weights = [mix[k] for k in kinds]
+    latencies = {k: [] for k in kinds}
+    errors = 0
+
+    started = time.perf_counter()
+    dm = DirectMessenger(address, name, PASSWORD, compress, binary)
+    latencies.setdefault('auth', []).append(time.perf_counter() - started)
+    for _ in range(ops):
+        kind = rng.choices(kinds, weights)[0]
+        started = time.perf_counter()
+        if kind == 'auth':
+            DirectMessenger(address, name, PASSWORD, compress, binary)._sock.close()
+        elif kind == 'send':
+            if not dm.send('benchmark message', f'bench{rng.randrange(users)}'):
+                errors += 1
+        elif kind == 'unread':
+            dm.retrieve_new()
+        else:
+            dm.retrieve_all()
+        latencies[kind].append(time.perf_counter() - started)
+    dm._sock.close()
+    latencies['errors'] = [errors]
+    return latencies
+
+
+def run_size(size: int, args) -> dict:
+    """
+    Benchmark one store size on a fresh server.
+    """
+    with tempfile.TemporaryDirectory() as store_dir:
+        users = max(args.users, args.clients)
+        # the memory store starts from the snapshot of a preloaded json store
+        memory = args.backend == 'memory'
+        preload(store_dir, 'json' if memory else args.backend, users, size)
+        # workers default to one per connection max_connections allows
+        limits = {'max_connections': max(args.clients * 4, server.MAX_CONNECTIONS)}
+        if args.processes > 1:
+            dsu = server.DSUCluster('127.0.0.1', 0, args.processes, store_dir=store_dir,
+                                    backend=args.backend, use_async=args.use_async, **limits)
+            target = dsu.start_server
+        else:
+            dsu = server.DSUServer('127.0.0.1', 0, store_dir=store_dir,
+                                   backend=args.backend, snapshot=memory, **limits)
+            target = dsu.start_async_server if args.use_async else dsu.start_server
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        if not dsu.ready.wait(30):
+            raise RuntimeError('server did not start')
+        address = f'127.0.0.1:{dsu.port}'
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(
+                lambda i: run_client(address, i, users, args.ops, args.mix, args.seed,
+                                     args.compress, args.binary),
+                range(args.clients)))
+        elapsed = time.perf_counter() - started
+
+        dsu.shutdown()
+        thread.join(30)
+
+    merged = {}
+    errors = 0
+    for result in results:
+        errors += result.pop('errors')[0]
+        for kind, samples in result.items():
+            merged.setdefault(kind, []).extend(samples)
+    total_ops = sum(len(samples) for samples in merged.values())
+    return {
+        'store_messages': size,
+        'operations': total_ops,
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput_ops_s': total_ops / elapsed if elapsed else 0.0,
+        'latency': {kind: percentiles(samples) for kind, samples in merged.items()},
+    }
+
+
+def compression_report(history: int, repeat: int = 5) -> dict:
+    """
+    Encode a fetch response holding `history` chat-like messages and
+    measure what zlib compression saves and costs (best of `repeat`).
+    """
+    rng = random.Random(history)
+    started = time.time()
+    messages = [WireMessage({'from': f'user{rng.randrange(5)}',
+                             'message': ' '.join(rng.choices(WORDS, k=rng.randint(2, 12))),
+                             'timestamp': str(started + i)})
+                for i in range(history)]
+    frame = encode_messages_response('ok', messages)
+    compress_s = decompress_s = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        packed = compress_frame(frame, 0)
+        t1 = time.perf_counter()
+        decompress_frame(packed.decode())
+        t2 = time.perf_counter()
+        compress_s = min(compress_s, t1 - t0)
+        decompress_s = min(decompress_s, t2 - t1)
+    return {
+        'messages': history,
+        'plain_bytes': len(frame),
+        'compressed_bytes': len(packed),
+        'saved_pct': 100 * (1 - len(packed) / len(frame)),
+        'compress_ms': compress_s * 1000,
+        'decompress_ms': decompress_s * 1000,
+    }
+
+
+def _rate(func, iterations: int) -> float:
+    """
+    Calls of func per second.
+    """
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - started)
+
+
+def codec_report(iterations: int, history: int = 50) -> dict:
+    """
+    Compare the JSON and binary encodings as a client sees them:
+    direct message requests encoded per second, and fetch responses
+    of `history` messages decoded per second.
+    """
+    rng = random.Random(history)
+    messages = [{'from': f'user{rng.randrange(5)}',
+                 'message': ' '.join(rng.choices(WORDS, k=rng.randint(2, 12))),
+                 'timestamp': str(1700000000.0 + i)} for i in range(history)]
+    token = server.generate_token()
+    json_fetch = encode_messages_response('ok', messages).decode()
+    binary_fetch = ds_protocol.pack_response('ok', '', messages)[ds_protocol.LENGTH.size:]
+    json_dm = ds_protocol.build_directmessage(token, 'see you at lab', 'user3', 1700000000.5)
+    binary_dm = ds_protocol.pack_directmessage(token, 'see you at lab', 'user3', 1700000000.5)
+    return {
+        'history': history,
+        'json': {
+            'encode_dm_per_s': _rate(lambda: ds_protocol.build_directmessage(
+                token, 'see you at lab', 'user3', 1700000000.5), iterations),
+            'decode_fetch_per_s': _rate(lambda: ds_protocol.parse_response(json_fetch),
+                                        max(1, iterations // 10)),
+            'dm_bytes': len(json_dm) + 2,
+            'fetch_bytes': len(json_fetch) + 2,
+        },
+        'binary': {
+            'encode_dm_per_s': _rate(lambda: ds_protocol.pack_directmessage(
+                token, 'see you at lab', 'user3', 1700000000.5), iterations),
+            'decode_fetch_per_s': _rate(lambda: ds_protocol.unpack_response(binary_fetch),
+                                        max(1, iterations // 10)),
+            'dm_bytes': len(binary_dm),
+            'fetch_bytes': len(binary_fetch) + ds_protocol.LENGTH.size,
+        },
+    }
+
+
+def print_codec(report: dict) -> None:
+    print(f"\n  {'encoding':<9}{'dm enc/s':>12}{'fetch dec/s':>13}{'dm B':>7}"
+          f"{'fetch B':>9}   (fetch of {report['history']} messages)")
+    for name in ('json', 'binary'):
+        row = report[name]
+        print(f"  {name:<9}{row['encode_dm_per_s']:>12.0f}{row['decode_fetch_per_s']:>13.0f}"
+              f"{row['dm_bytes']:>7}{row['fetch_bytes']:>9}")
+
+
+def print_compression(rows: List[dict]) -> None:
+    print(f"\n  {'messages':>9}{'plain B':>11}{'zlib B':>10}{'saved':>8}"
+          f"{'comp ms':>10}{'decomp ms':>11}")
+    for row in rows:
+        print(f"  {row['messages']:>9}{row['plain_bytes']:>11}{row['compressed_bytes']:>10}"
+              f"{row['saved_pct']:>7.1f}%{row['compress_ms']:>10.3f}{row['decompress_ms']:>11.3f}")
+
+
+def print_result(result: dict) -> None:
+    print(f"\nstore size {result['store_messages']}: "
+          f"{result['operations']} ops in {result['seconds']:.2f}s = "
+          f"{result['throughput_ops_s']:.0f} ops/s ({result['errors']} errors)")
+    print(f"  {'op':<8}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, stats in sorted(result['latency'].items()):
+        if stats['count']:
+            print(f"  {kind:<8}{stats['count']:>8}{stats['p50_ms']:>10.2f}"
+                  f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description='Benchmark the DSU chat server.')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent simulated clients')
+    parser.add_argument('--ops', type=int, default=100, help='operations per client')
+    parser.add_argument('--users', type=int, default=32, help='users in the store')
+    parser.add_argument('--sizes', default='0,1000,10000',
+                        help='comma separated store sizes (preloaded messages)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, e.g. auth=1,send=6,unread=2,all=1')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='json')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='use the asyncio server engine')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='server worker processes (needs --backend sqlite)')
+    parser.add_argument('--compress', action='store_true',
+                        help='clients negotiate zlib compression')
+    parser.add_argument('--compression', default='',
+                        help='comma separated history sizes to measure compression on')
+    parser.add_argument('--binary', action='store_true',
+                        help='clients negotiate the binary encoding')
+    parser.add_argument('--codec', type=int, default=0,
+                        help='iterations of the JSON vs binary encoding comparison')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    report = {
+        'config': {
+            'clients': args.clients, 'ops': args.ops, 'users': args.users,
+            'mix': args.mix, 'backend': args.backend,
+            'engine': 'asyncio' if args.use_async else 'threads',
+            'processes': args.processes,
+            'compress': args.compress,
+            'encoding': 'binary' if args.binary else 'json',
+            'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': [],
+    }
+    for size in (int(s) for s in args.sizes.split(',') if s):
+        result = run_size(size, args)
+        print_result(result)
+        report['results'].append(result)
+    if args.compression:
+        report['compression'] = [compression_report(int(s))
+                                 for s in args.compression.split(',')]
+        print_compression(report['compression'])
+    if args.codec:
+        report['codec'] = codec_report(args.codec)
+        print_codec(report['codec'])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nResults written to {args.output}')
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# ds_bus.py
+
+# Alex Madas
+# Madasa
+# 39847840
+
+"""
+ds_bus.py
+
+A local message bus between the worker processes of a multi-process
+DSU server, over a Unix socket.
+
+The parent process runs a BusHub. Every worker connects a BusClient
+to it and publishes events: small dicts sent as JSON lines. The hub
+relays each line, unparsed, to every other worker, whose client hands
+the decoded event to a callback on its reader thread. The server uses
+it to tell the other workers that a user has new messages (so a
+subscriber is pushed whichever worker it is connected to) and that
+sessions were started, resumed or detached (so a client can resume
+its session on any worker).
+
+Delivery is best effort and in order per publisher. Nothing is
+stored: a worker that connects late only sees later events.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+
+BUS_FILE = 'bus.sock'      # socket file, in the store directory
+CONNECT_TIMEOUT = 10       # seconds a client waits for the hub to appear
+RECV_SIZE = 65536
+
+
+class BusHub:
+    """
+    Relays every line a client sends to all the other clients.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._clients = []
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def start(self) -> None:
+        """
+        Listen on the socket file, replacing a stale one, and accept
+        clients on a background thread.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def close(self) -> None:
+        """
+        Stop accepting, drop every client and remove the socket file.
+        """
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept_loop(self) -> None:
+        sock = self._sock
+        while True:
+            try:
+                client, _ = sock.accept()
+            except OSError:  # closed
+                return
+            with self._lock:
+                self._clients.append(client)
+            threading.Thread(target=self._relay, args=(client,), daemon=True).start()
+
+    def _relay(self, client: socket.socket) -> None:
+        """
+        Forward the complete lines read from one client to the others.
+        """
+        pending = b''
+        try:
+            while True:
+                data = client.recv(RECV_SIZE)
+                if not data:
+                    break
+                pending += data
+                end = pending.rfind(b'\n') + 1
+                if not end:
+                    continue
+                lines, pending = pending[:end], pending[end:]
+                with self._lock:
+                    others = [c for c in self._clients if c is not client]
+                    for other in others:
+                        try:
+                            other.sendall(lines)
+                        except OSError:  # that worker is gone
+                            pass
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+            client.close()
+
+
+class BusClient:
+    """
+    One worker's connection to the hub. `on_event` is called with each
+    event another worker publishes, on the client's reader thread.
+    """
+    def __init__(self, path: str, on_event):
+        self.path = path
+        self.on_event = on_event
+        self._sock = None
+        self._reader = None
+        self._send_lock = threading.Lock()
+
+    def connect(self) -> None:
+        """
+        Connect to the hub, waiting up to CONNECT_TIMEOUT seconds for
+        it to start listening, and start reading events.
+
+        Raises:
+            OSError: if the hub cannot be reached.
+        """
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self._sock = sock
+        self._reader = threading.Thread(target=self._read_loop, args=(sock,), daemon=True)
+        self._reader.start()
+
+    def close(self) -> None:
+        """
+        Disconnect, and wait for an event being handled to finish, so
+        nothing the callback uses is torn down under it.
+        """
+        with self._send_lock:
+            sock, self._sock = self._sock, None
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+
+    def publish(self, event: dict) -> None:
+        """
+        Send an event to every other worker. Dropped if the hub is gone.
+        """
+        line = json.dumps(event).encode() + b'\n'
+        with self._send_lock:
+            if self._sock is None:
+                return
+            try:
+                self._sock.sendall(line)
+            except OSError:
+                pass
+
+    def _read_loop(self, sock: socket.socket) -> None:
+        reader = sock.makefile('rb')
+        try:
+            for line in reader:
+                try:
+                    self.on_event(json.loads(line))
+                except Exception as e:  # a bad event must not stop the bus
+                    print(f'Bus event failed: {e}')
+        except (OSError, ValueError):  # closed
+            pass
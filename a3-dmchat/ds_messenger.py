@@ -15,16 +15,41 @@ Provides DirectMessenger for the DSP server protocol and
 a DirectMessage container class.
 """
 
+import queue
 import socket
+import threading
 import time
-from typing import List
+import uuid
+from typing import Iterator, List, Union
 from ds_protocol import (
+    COMPRESSION,
+    DSPResponse,
+    ENCODING_BINARY,
+    LENGTH,
+    RESPONSE_TYPES,
     build_authenticate,
     build_directmessage,
     build_fetch,
-    parse_response
+    build_fetch_since,
+    build_fetch_page,
+    build_resume,
+    build_search,
+    build_subscribe,
+    compress_frame,
+    decompress_frame,
+    pack_directmessage,
+    pack_fetch,
+    pack_fetch_page,
+    pack_fetch_since,
+    pack_groupmessage,
+    pack_search,
+    pack_subscribe,
+    parse_response,
+    unpack_response
 )
 
+PUSH_TYPE = bytes([RESPONSE_TYPES.index("push")])  # first byte of a binary push
+
 class DirectMessage:
     """
     A simple container for one direct message.
@@ -43,54 +68,246 @@ class DirectMessenger:
     def __init__(self,
                  dsuserver: str = "127.0.0.1:3001",
                  username:  str = None,
-                 password:  str = None):
+                 password:  str = None,
+                 compress:  bool = False,
+                 binary:    bool = False):
         """
         Open a TCP connection to the DSP server at host:port,
         authenticate immediately, and save the returned token.
+        With `compress`, ask the server to zlib compress large frames
+        (both ways); with `binary`, ask to use the compact binary
+        encoding instead of JSON after authenticating.  Servers that
+        do not support either simply decline.
 
         Raises:
             ValueError: if authentication fails.
         """
+        self._dsuserver = dsuserver
+        self._username  = username
+        self._password  = password
+        self._want_compress = compress
+        self._want_binary   = binary
+        self._compress  = False     # agreed with the server
+        self._binary    = False     # agreed with the server
+        # messages pushed by the server survive a reconnect
+        self._pushed    = queue.Queue()
+        # whether the server pushes new messages (renewed on reconnect)
+        self.subscribed = False
+        self._connect()
+
+        # authenticate and store token
+        auth_json = build_authenticate(username, password, compress, binary)
+        self._send_raw(auth_json)
+        resp = parse_response(self._recv_raw())
+        if resp.type != "ok":
+            raise ValueError(f"Authentication failed: {resp.message}")
+        self.token = resp.token
+        self._agreed(resp)
+
+    def _connect(self) -> None:
+        """
+        Open the TCP connection to host:port.
+        """
         # parse "host:port"
-        host, port_str = dsuserver.split(":")
+        host, port_str = self._dsuserver.split(":")
         port = int(port_str)
 
-        # 1) establish socket connection once
+        # 1) establish socket connection
         self._sock   = socket.create_connection((host, port))
         # 2) file-like wrappers for line-based I/O
         self._send_f = self._sock.makefile("w")
         self._recv_f = self._sock.makefile("r")
+        # once subscribed, the response frames handed over by the
+        # background reader thread, which sets _lost when the
+        # connection closes
+        self._responses = None
+        self._lost      = False
+        self._compress  = False
+        self._binary    = False
 
-        # 3) authenticate and store token
-        auth_json = build_authenticate(username, password)
-        self._send_raw(auth_json)
+    def _agreed(self, resp) -> None:
+        """
+        Apply the compression / encoding the server agreed to in its
+        reply to authenticate or resume.
+        """
+        self._compress = resp.compress == COMPRESSION
+        self._binary   = resp.encoding == ENCODING_BINARY
+        if self._binary:
+            # the server sends nothing after its reply until asked, so
+            # the text reader holds no binary bytes
+            self._send_b = self._sock.makefile("wb")
+            self._recv_b = self._sock.makefile("rb")
+
+    def reconnect(self) -> bool:
+        """
+        Open a new connection after the old one dropped and resume the
+        session on it.  If the server no longer knows the session (it
+        expired or the server restarted), authenticate again.
+        Returns True if the session was resumed, False if a new one
+        had to be started.  A subscription is renewed on the new
+        connection (check `subscribed` in case the server declined).
+
+        Raises:
+            ValueError: if authentication fails.
+        """
+        renew, self.subscribed = self.subscribed, False
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        self._connect()
+        self._send_raw(build_resume(self.token, self._want_compress, self._want_binary))
         resp = parse_response(self._recv_raw())
-        if resp.type != "ok":
-            raise ValueError(f"Authentication failed: {resp.message}")
-        self.token = resp.token
+        resumed = resp.type == "ok"
+        if not resumed:
+            self._send_raw(build_authenticate(self._username, self._password,
+                                              self._want_compress, self._want_binary))
+            resp = parse_response(self._recv_raw())
+            if resp.type != "ok":
+                raise ValueError(f"Authentication failed: {resp.message}")
+            self.token = resp.token
+        self._agreed(resp)
+        if renew:
+            self.subscribe()
+        return resumed
 
     def _send_raw(self, json_str: str) -> None:
         """
         Write one JSON request line (with CRLF) and flush.
         """
+        if self._compress:
+            json_str = compress_frame(json_str.encode()).decode()
         self._send_f.write(json_str + "\r\n")
         self._send_f.flush()
 
-    def _recv_raw(self) -> str:
+    def _request(self, build, pack, *args) -> DSPResponse:
+        """
+        Send one request, encoded with the JSON builder `build` or, on a
+        binary connection, the binary packer `pack`, and return the
+        server's response.
+        """
+        if self._binary:
+            self._send_b.write(pack(self.token, *args))
+            self._send_b.flush()
+        else:
+            self._send_raw(build(self.token, *args))
+        return self._recv_response()
+
+    def _recv_response(self) -> DSPResponse:
+        """
+        Read and parse the next response, in either encoding.
+        """
+        frame = self._recv_raw()
+        if isinstance(frame, bytes):
+            return unpack_response(frame)
+        return parse_response(frame)
+
+    def _recv_raw(self):
         """
-        Read one line (up to CRLF) from the server.
+        Read one response frame from the server: a line (up to CRLF),
+        or a payload on a binary connection.
+        Pushed messages that arrive first are set aside for
+        retrieve_pushed().
         """
-        return self._recv_f.readline().strip()
+        if self._responses is not None:
+            return self._responses.get()
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return ""   # connection closed
+            if not self._stash_push(frame):
+                return frame
 
-    def send(self, message: str, recipient: str) -> bool:
+    def _read_frame(self, binary: bool = None, reader=None):
+        """
+        Read the next frame in the agreed encoding (or `binary`, from
+        `reader`): a line, decompressed if it was sent compressed, or a
+        binary payload.  Returns None once the connection is closed.
+        """
+        if binary is None:
+            binary = self._binary
+        if reader is None:
+            reader = self._recv_b if binary else self._recv_f
+        if not binary:
+            line = reader.readline()
+            if not line:
+                return None
+            return decompress_frame(line.strip())
+        header = reader.read(LENGTH.size)
+        if len(header) < LENGTH.size:
+            return None
+        (size,) = LENGTH.unpack(header)
+        return reader.read(size)
+
+    def _stash_push(self, frame) -> bool:
+        """
+        If `frame` (a line or a binary payload) is a push frame, queue
+        its messages and return True.
         """
-        Send `message` to `recipient`.  Returns True if the server
-        acknowledges with type=="ok", False otherwise.
+        if isinstance(frame, bytes):
+            if frame[:1] != PUSH_TYPE:
+                return False
+            resp = unpack_response(frame)
+        else:
+            if '"push"' not in frame:
+                return False
+            resp = parse_response(frame)
+            if resp.type != "push":
+                return False
+        for d in resp.messages or []:
+            self._pushed.put(self._dict_to_dm(d))
+        return True
+
+    def _read_loop(self) -> None:
+        """
+        Background reader used after subscribe(): routes push frames to
+        the push queue and everything else to the waiting request.
+        """
+        # bound to this connection: after reconnect() the thread reading
+        # the old one just runs out
+        responses = self._responses
+        binary = self._binary
+        reader = self._recv_b if binary else self._recv_f
+        while True:
+            try:
+                frame = self._read_frame(binary, reader)
+            except (OSError, ValueError):   # reset, or closed under us
+                frame = None
+            if frame is None:
+                if self._responses is responses:
+                    self._lost = True
+                responses.put("")   # connection closed
+                return
+            if frame and not self._stash_push(frame):
+                responses.put(frame)
+
+    def send(self, message: str, recipient: Union[str, List[str]],
+             retries: int = 1) -> bool:
+        """
+        Send `message` to `recipient`, or to every user in a list of
+        recipients (stored once by the server, all or nothing).
+        If the connection fails before the server answers, reconnect
+        and send again, up to `retries` times.  Every attempt carries
+        the same message id, so the server stores the message once
+        even if an earlier attempt did reach it.
+        Returns True if the server acknowledges with type=="ok",
+        False otherwise.
+
+        Raises:
+            OSError / ValueError: if the last attempt fails too.
         """
         ts = time.time()
-        dm_json = build_directmessage(self.token, message, recipient, ts)
-        self._send_raw(dm_json)
-        resp = parse_response(self._recv_raw())
+        message_id = uuid.uuid4().hex
+        pack = pack_groupmessage if isinstance(recipient, list) else pack_directmessage
+        for attempt in range(retries + 1):
+            try:
+                resp = self._request(build_directmessage, pack, message,
+                                     recipient, ts, message_id)
+                break
+            except (OSError, ValueError):   # dropped, or closed mid-reply
+                if attempt == retries:
+                    raise
+                self.reconnect()
         return resp.type == "ok"
 
     def _dict_to_dm(self, data: dict) -> DirectMessage:
@@ -111,8 +328,7 @@ class DirectMessenger:
         Fetch only unread messages (`fetch:"unread"`) and return
         them as a list of DirectMessage objects.
         """
-        self._send_raw(build_fetch(self.token, "unread"))
-        resp = parse_response(self._recv_raw())
+        resp = self._request(build_fetch, pack_fetch, "unread")
         if resp.type != "ok" or not resp.messages:
             return []
         return [self._dict_to_dm(d) for d in resp.messages]
@@ -122,9 +338,106 @@ class DirectMessenger:
         Fetch all messages (`fetch:"all"`) and return
         them as a list of DirectMessage objects.
         """
-        self._send_raw(build_fetch(self.token, "all"))
-        resp = parse_response(self._recv_raw())
+        resp = self._request(build_fetch, pack_fetch, "all")
+        if resp.type != "ok" or not resp.messages:
+            return []
+        return [self._dict_to_dm(d) for d in resp.messages]
+
+    def retrieve_since(self, since: float) -> List[DirectMessage]:
+        """
+        Fetch only the messages newer than the timestamp `since`
+        and return them oldest first as a list of DirectMessage objects.
+        Unlike retrieve_new, this does not mark anything as read.
+        """
+        resp = self._request(build_fetch_since, pack_fetch_since, since)
+        if resp.type != "ok" or not resp.messages:
+            return []
+        return [self._dict_to_dm(d) for d in resp.messages]
+
+    def retrieve_page(self, after: float = None, before: float = None,
+                      limit: int = None) -> List[DirectMessage]:
+        """
+        Fetch one page of messages: those with after < timestamp < before
+        (both optional), oldest first, at most `limit` of them.  With
+        only `before` and a limit you get the newest page before it, so
+        passing the first timestamp of a page as `before` scrolls back
+        through history.  Does not mark anything as read.
+        """
+        resp = self._request(build_fetch_page, pack_fetch_page, after, before, limit)
         if resp.type != "ok" or not resp.messages:
             return []
         return [self._dict_to_dm(d) for d in resp.messages]
-    
\ No newline at end of file
+
+    def iter_messages(self, after: float = None, before: float = None,
+                      limit: int = None) -> Iterator[DirectMessage]:
+        """
+        Stream messages with after < timestamp < before (both optional),
+        oldest first, at most `limit` of them.  The server sends them a
+        chunk at a time and they are yielded as each chunk arrives, so
+        memory stays bounded however large the mailbox.  Does not mark
+        anything as read.  If the loop stops early the rest of the
+        stream is read and discarded.
+        """
+        resp = self._request(build_fetch_page, pack_fetch_page, after, before, limit, True)
+        finished = False
+        try:
+            while True:
+                if resp.type != "chunk":
+                    finished = True
+                    if resp.type == "error":
+                        raise ValueError(f"Fetch failed: {resp.message}")
+                    return
+                for d in resp.messages or []:
+                    yield self._dict_to_dm(d)
+                resp = self._recv_response()
+        finally:
+            while not finished:
+                finished = self._recv_response().type != "chunk"
+
+    def search(self, query: str, contact: str = None, after: float = None,
+               before: float = None, limit: int = None) -> List[DirectMessage]:
+        """
+        Search your messages on the server for those containing every
+        word of `query` (case-insensitive), optionally only those
+        exchanged with `contact` and with after < timestamp < before.
+        Returns the hits oldest first, at most the `limit` most recent.
+        Does not mark anything as read.
+        """
+        resp = self._request(build_search, pack_search, query, contact, after, before, limit)
+        if resp.type != "ok" or not resp.messages:
+            return []
+        return [self._dict_to_dm(d) for d in resp.messages]
+
+    def subscribe(self) -> bool:
+        """
+        Ask the server to push new messages to this connection as they
+        arrive.  Returns True on success; from then on collect them with
+        retrieve_pushed() instead of polling with retrieve_new().
+        """
+        resp = self._request(build_subscribe, pack_subscribe)
+        self.subscribed = resp.type == "ok"
+        if not self.subscribed:
+            return False
+        if self._responses is None:
+            self._responses = queue.Queue()
+            threading.Thread(target=self._read_loop, daemon=True).start()
+        return True
+
+    def retrieve_pushed(self) -> List[DirectMessage]:
+        """
+        Return the messages the server has pushed since the last call.
+        Never touches the network.
+
+        Raises:
+            ConnectionError: if the subscribed connection has closed and
+            every message it delivered was already returned; reconnect()
+            to get pushes again.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self._pushed.get_nowait())
+            except queue.Empty:
+                if not messages and self._lost:
+                    raise ConnectionError("Connection to the server was lost")
+                return messages
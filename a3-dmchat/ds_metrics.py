@@ -0,0 +1,134 @@
+# ds_metrics.py
+
+# Alex Madas
+# Madasa
+# 39847840
+
+"""
+ds_metrics.py
+
+Runtime metrics for the DSU server: a latency histogram per command
+type, time spent waiting for and holding storage locks, bytes in and
+out, and connection counts.
+
+Collection is switched on and off at runtime (ServerMetrics.enabled).
+When it is off the server skips every timing call, so the only cost
+left on the hot path is one attribute check.
+"""
+
+import threading
+
+BUCKETS = 32  # log2 buckets of microseconds: up to ~36 minutes
+
+
+class LatencyHistogram:
+    """
+    Durations counted in power-of-two microsecond buckets. Recording is
+    O(1); percentiles are the upper bound of the bucket they fall in.
+    """
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """
+        Add one duration, in seconds.
+        """
+        micros = int(seconds * 1_000_000)
+        self.counts[min(micros.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """
+        Approximate p-th percentile (0-100), in milliseconds.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << bucket) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max * 1000,
+        }
+
+
+class ServerMetrics:
+    """
+    Everything the server measures about itself. Safe to update from
+    any thread.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.connections = 0  # open client connections, always tracked
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clear every histogram and byte counter.
+        """
+        with self._lock:
+            self.commands = {}
+            self.lock_wait = LatencyHistogram()
+            self.lock_hold = LatencyHistogram()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def record_command(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            if kind not in self.commands:
+                self.commands[kind] = LatencyHistogram()
+            self.commands[kind].record(seconds)
+
+    def record_lock(self, wait: float, hold: float) -> None:
+        """
+        Observer for the storage engine: how long a lock was waited
+        for, and then held.
+        """
+        with self._lock:
+            self.lock_wait.record(wait)
+            self.lock_hold.record(hold)
+
+    def add_bytes(self, inbound: int = 0, outbound: int = 0) -> None:
+        with self._lock:
+            self.bytes_in += inbound
+            self.bytes_out += outbound
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self.connections -= 1
+
+    def snapshot(self) -> dict:
+        """
+        All metrics as a JSON-serializable dict.
+        """
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'connections': self.connections,
+                'commands': {k: h.snapshot() for k, h in self.commands.items()},
+                'lock_wait': self.lock_wait.snapshot(),
+                'lock_hold': self.lock_hold.snapshot(),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
@@ -12,18 +12,73 @@
 ds_protocol.py
 
 Implements JSON builders and parser for the Direct Messaging Protocol.
+
+Compression: a client may ask for it in authenticate ("compress":
+"zlib"). If the server agrees it says so in its reply, and from then on
+either side may send a frame of COMPRESS_THRESHOLD bytes or more as
+{"z": "<base64 of the zlib compressed frame>"}. The wrapper is plain
+JSON text, so CRLF framing is unaffected. Smaller frames stay plain.
+
+Binary encoding: a client may instead ask for "encoding": "binary" in
+authenticate. Once the server's (JSON) reply confirms it, both sides
+switch to length-prefixed binary frames, packed with struct:
+
+    frame     = payload length (uint32) + payload
+    request   = opcode (uint8) + token + opcode specific fields
+    response  = type (uint8) + message + message count (uint32) + messages
+    message   = direction (uint8, 0 "from" / 1 "recipient") + peer + text
+                + timestamp (float64)
+    string    = byte length (uint32) + UTF-8 bytes
+
+A direct message may end with one more string, its client message id.
+All integers and floats are big-endian. pack_* build request frames,
+unpack_request() turns one back into the command dict its JSON form
+would have produced, and pack_response() / unpack_response() do the
+same for responses.
 """
 
+import base64
+import binascii
 import json
+import struct
+import zlib
 from collections import namedtuple
 from json import JSONDecodeError
 
+COMPRESSION = 'zlib'        # the one compression scheme on offer
+COMPRESS_THRESHOLD = 1024   # frames (bytes) below this are sent plain
+COMPRESS_LEVEL = 6
+ENCODING_BINARY = 'binary'  # the negotiated binary encoding
+
+OP_DIRECTMESSAGE = 1
+OP_FETCH_ALL = 2
+OP_FETCH_UNREAD = 3
+OP_FETCH_SINCE = 4
+OP_FETCH_PAGE = 5
+OP_SUBSCRIBE = 6
+OP_SEARCH = 7
+OP_GROUPMESSAGE = 8
+RESPONSE_TYPES = ('ok', 'error', 'push', 'chunk', 'end')
+PAGE_AFTER, PAGE_BEFORE, PAGE_LIMIT, PAGE_STREAM = 1, 2, 4, 8  # fetch page flags
+SEARCH_CONTACT = 16  # search flag, alongside PAGE_AFTER / BEFORE / LIMIT
+
+LENGTH = struct.Struct('!I')
+_DOUBLE = struct.Struct('!d')
+_BYTE = struct.Struct('!B')
+_PAGE = struct.Struct('!BddI')      # flags, after, before, limit
+_RESPONSE = struct.Struct('!B')
+
 # Define a simple tuple-like class to hold every server response
-DSPResponse = namedtuple('DSPResponse', ['type', 'message', 'token', 'messages'])
+DSPResponse = namedtuple('DSPResponse',
+                         ['type', 'message', 'token', 'messages', 'compress', 'encoding'],
+                         defaults=(None, None))
 
-def build_authenticate(username: str, password: str) -> str:
+def build_authenticate(username: str, password: str, compress: bool = False,
+                       binary: bool = False) -> str:
     """
     Build a JSON string to authenticate a user.
+    With `compress`, ask the server to compress large frames; with
+    `binary`, ask to switch to the binary encoding afterwards.
     """
     payload = {
         "authenticate": {
@@ -31,12 +86,22 @@ def build_authenticate(username: str, password: str) -> str:
             "password": password
         }
     }
+    if compress:
+        payload["authenticate"]["compress"] = COMPRESSION
+    if binary:
+        payload["authenticate"]["encoding"] = ENCODING_BINARY
     return json.dumps(payload)
 
-def build_directmessage(token: str, entry: str, recipient: str, timestamp: float) -> str:
+def build_directmessage(token: str, entry: str, recipient, timestamp: float,
+                        message_id: str = None) -> str:
     """
     Build a JSON string to send a direct message.
+    `recipient` may also be a list of usernames, to send the message
+    to each of them as one group message.
     `timestamp` will be converted to a string.
+    `message_id` is an optional client-generated id: the server stores a
+    message only once however many times it is sent with the same id,
+    so a send can be retried safely.
     """
     payload = {
         "token": token,
@@ -46,6 +111,8 @@ def build_directmessage(token: str, entry: str, recipient: str, timestamp: float
             "timestamp": str(timestamp)
         }
     }
+    if message_id is not None:
+        payload["directmessage"]["message_id"] = message_id
     return json.dumps(payload)
 
 def build_fetch(token: str, what: str) -> str:
@@ -59,6 +126,327 @@ def build_fetch(token: str, what: str) -> str:
     }
     return json.dumps(payload)
 
+def build_fetch_since(token: str, since: float) -> str:
+    """
+    Build a JSON string to fetch only the messages newer than `since`,
+    the timestamp of the last message the client has seen.
+    `since` will be converted to a string.
+    """
+    payload = {
+        "token": token,
+        "fetch": {"since": str(since)}
+    }
+    return json.dumps(payload)
+
+def build_fetch_page(token: str, after: float = None, before: float = None,
+                     limit: int = None, stream: bool = False) -> str:
+    """
+    Build a JSON string to fetch the messages with after < timestamp
+    < before (both optional), at most `limit` of them. With `stream`
+    the server sends every match in "chunk" frames followed by an
+    "end" frame instead of one response.
+    Timestamps will be converted to strings.
+    """
+    page = {}
+    if after is not None:
+        page["after"] = str(after)
+    if before is not None:
+        page["before"] = str(before)
+    if limit is not None:
+        page["limit"] = limit
+    if stream:
+        page["stream"] = True
+    payload = {
+        "token": token,
+        "fetch": page
+    }
+    return json.dumps(payload)
+
+def build_search(token: str, query: str, contact: str = None, after: float = None,
+                 before: float = None, limit: int = None) -> str:
+    """
+    Build a JSON string to search the user's messages for those
+    containing every word of `query`, optionally only those exchanged
+    with `contact` and with after < timestamp < before, at most `limit`
+    (the most recent) of them.
+    Timestamps will be converted to strings.
+    """
+    search = {"query": query}
+    if contact is not None:
+        search["contact"] = contact
+    if after is not None:
+        search["after"] = str(after)
+    if before is not None:
+        search["before"] = str(before)
+    if limit is not None:
+        search["limit"] = limit
+    payload = {
+        "token": token,
+        "search": search
+    }
+    return json.dumps(payload)
+
+def build_subscribe(token: str, enable: bool = True) -> str:
+    """
+    Build a JSON string that turns server push of new direct
+    messages on (or off) for this connection.
+    """
+    payload = {
+        "token": token,
+        "subscribe": enable
+    }
+    return json.dumps(payload)
+
+def build_resume(token: str, compress: bool = False, binary: bool = False) -> str:
+    """
+    Build a JSON string that resumes an earlier session on a new
+    connection, instead of authenticating again.
+    `compress` and `binary` are as for build_authenticate.
+    """
+    payload = {
+        "resume": {
+            "token": token
+        }
+    }
+    if compress:
+        payload["resume"]["compress"] = COMPRESSION
+    if binary:
+        payload["resume"]["encoding"] = ENCODING_BINARY
+    return json.dumps(payload)
+
+def compress_frame(frame: bytes, threshold: int = COMPRESS_THRESHOLD) -> bytes:
+    """
+    Wrap one encoded JSON frame (without its CRLF) as a compressed
+    frame, or return it unchanged if it is shorter than `threshold`.
+    """
+    if len(frame) < threshold:
+        return frame
+    packed = base64.b64encode(zlib.compress(frame, COMPRESS_LEVEL))
+    return b'{"z": "' + packed + b'"}'
+
+def decompress_frame(frame: str, max_size: int = None) -> str:
+    """
+    Return the JSON text inside a compressed frame, or `frame` itself
+    if it is not compressed.
+    Raises ValueError if it cannot be decoded or would expand to more
+    than `max_size` bytes.
+    """
+    if not frame.startswith('{"z": "'):
+        return frame
+    try:
+        packed = base64.b64decode(json.loads(frame)['z'], validate=True)
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(packed, max_size or 0)
+        if inflater.unconsumed_tail:
+            raise ValueError(f"Compressed frame expands beyond {max_size} bytes")
+        return data.decode()
+    except (JSONDecodeError, KeyError, TypeError, zlib.error, UnicodeDecodeError,
+            binascii.Error) as e:
+        raise ValueError(f"Invalid compressed frame: {e}") from e
+
+def _pack_str(text: str) -> bytes:
+    data = text.encode()
+    return LENGTH.pack(len(data)) + data
+
+def _unpack_str(payload: bytes, offset: int):
+    (size,) = LENGTH.unpack_from(payload, offset)
+    start = offset + LENGTH.size
+    end = start + size
+    if end > len(payload):
+        raise ValueError("Truncated string in binary frame")
+    return payload[start:end].decode(), end
+
+def pack_frame(payload: bytes) -> bytes:
+    """
+    Prefix a binary payload with its length.
+    """
+    return LENGTH.pack(len(payload)) + payload
+
+def pack_directmessage(token: str, entry: str, recipient: str, timestamp: float,
+                       message_id: str = None) -> bytes:
+    """
+    Binary form of build_directmessage.
+    """
+    return pack_frame(_BYTE.pack(OP_DIRECTMESSAGE) + _pack_str(token) + _pack_str(entry)
+                      + _pack_str(recipient) + _DOUBLE.pack(float(timestamp))
+                      + (_pack_str(message_id) if message_id is not None else b""))
+
+def pack_groupmessage(token: str, entry: str, recipients: list, timestamp: float,
+                      message_id: str = None) -> bytes:
+    """
+    Binary form of build_directmessage with a list of recipients.
+    """
+    names = b"".join(_pack_str(recipient) for recipient in recipients)
+    return pack_frame(_BYTE.pack(OP_GROUPMESSAGE) + _pack_str(token) + _pack_str(entry)
+                      + LENGTH.pack(len(recipients)) + names + _DOUBLE.pack(float(timestamp))
+                      + (_pack_str(message_id) if message_id is not None else b""))
+
+def pack_fetch(token: str, what: str) -> bytes:
+    """
+    Binary form of build_fetch.
+    """
+    op = OP_FETCH_ALL if what == "all" else OP_FETCH_UNREAD
+    return pack_frame(_BYTE.pack(op) + _pack_str(token))
+
+def pack_fetch_since(token: str, since: float) -> bytes:
+    """
+    Binary form of build_fetch_since.
+    """
+    return pack_frame(_BYTE.pack(OP_FETCH_SINCE) + _pack_str(token) + _DOUBLE.pack(float(since)))
+
+def pack_fetch_page(token: str, after: float = None, before: float = None,
+                    limit: int = None, stream: bool = False) -> bytes:
+    """
+    Binary form of build_fetch_page.
+    """
+    flags = ((PAGE_AFTER if after is not None else 0) | (PAGE_BEFORE if before is not None else 0)
+             | (PAGE_LIMIT if limit is not None else 0) | (PAGE_STREAM if stream else 0))
+    fields = _PAGE.pack(flags, float(after or 0), float(before or 0), limit or 0)
+    return pack_frame(_BYTE.pack(OP_FETCH_PAGE) + _pack_str(token) + fields)
+
+def pack_subscribe(token: str, enable: bool = True) -> bytes:
+    """
+    Binary form of build_subscribe.
+    """
+    return pack_frame(_BYTE.pack(OP_SUBSCRIBE) + _pack_str(token) + _BYTE.pack(bool(enable)))
+
+def pack_search(token: str, query: str, contact: str = None, after: float = None,
+                before: float = None, limit: int = None) -> bytes:
+    """
+    Binary form of build_search.
+    """
+    flags = ((PAGE_AFTER if after is not None else 0) | (PAGE_BEFORE if before is not None else 0)
+             | (PAGE_LIMIT if limit is not None else 0) | (SEARCH_CONTACT if contact is not None else 0))
+    fields = _PAGE.pack(flags, float(after or 0), float(before or 0), limit or 0)
+    return pack_frame(_BYTE.pack(OP_SEARCH) + _pack_str(token) + _pack_str(query)
+                      + _pack_str(contact or "") + fields)
+
+def unpack_request(payload: bytes) -> dict:
+    """
+    Decode a binary request payload into the command dict its JSON
+    form would have produced. Raises ValueError if it is malformed.
+    """
+    try:
+        (op,) = _BYTE.unpack_from(payload, 0)
+        token, offset = _unpack_str(payload, 1)
+        if op == OP_DIRECTMESSAGE:
+            entry, offset = _unpack_str(payload, offset)
+            recipient, offset = _unpack_str(payload, offset)
+            (timestamp,) = _DOUBLE.unpack_from(payload, offset)
+            offset += _DOUBLE.size
+            command = {"directmessage": {"entry": entry, "recipient": recipient,
+                                         "timestamp": str(timestamp)}}
+            if offset < len(payload):
+                command["directmessage"]["message_id"], offset = _unpack_str(payload, offset)
+        elif op == OP_GROUPMESSAGE:
+            entry, offset = _unpack_str(payload, offset)
+            (count,) = LENGTH.unpack_from(payload, offset)
+            offset += LENGTH.size
+            recipients = []
+            for _ in range(count):
+                recipient, offset = _unpack_str(payload, offset)
+                recipients.append(recipient)
+            (timestamp,) = _DOUBLE.unpack_from(payload, offset)
+            offset += _DOUBLE.size
+            command = {"directmessage": {"entry": entry, "recipient": recipients,
+                                         "timestamp": str(timestamp)}}
+            if offset < len(payload):
+                command["directmessage"]["message_id"], offset = _unpack_str(payload, offset)
+        elif op in (OP_FETCH_ALL, OP_FETCH_UNREAD):
+            command = {"fetch": "all" if op == OP_FETCH_ALL else "unread"}
+        elif op == OP_FETCH_SINCE:
+            (since,) = _DOUBLE.unpack_from(payload, offset)
+            offset += _DOUBLE.size
+            command = {"fetch": {"since": since}}
+        elif op == OP_FETCH_PAGE:
+            flags, after, before, limit = _PAGE.unpack_from(payload, offset)
+            offset += _PAGE.size
+            page = {}
+            if flags & PAGE_AFTER:
+                page["after"] = after
+            if flags & PAGE_BEFORE:
+                page["before"] = before
+            if flags & PAGE_LIMIT:
+                page["limit"] = limit
+            if flags & PAGE_STREAM:
+                page["stream"] = True
+            command = {"fetch": page}
+        elif op == OP_SUBSCRIBE:
+            (enable,) = _BYTE.unpack_from(payload, offset)
+            offset += _BYTE.size
+            command = {"subscribe": bool(enable)}
+        elif op == OP_SEARCH:
+            query, offset = _unpack_str(payload, offset)
+            contact, offset = _unpack_str(payload, offset)
+            flags, after, before, limit = _PAGE.unpack_from(payload, offset)
+            offset += _PAGE.size
+            search = {"query": query}
+            if flags & SEARCH_CONTACT:
+                search["contact"] = contact
+            if flags & PAGE_AFTER:
+                search["after"] = after
+            if flags & PAGE_BEFORE:
+                search["before"] = before
+            if flags & PAGE_LIMIT:
+                search["limit"] = limit
+            command = {"search": search}
+        else:
+            raise ValueError(f"Unknown binary opcode {op}")
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid binary request: {e}") from e
+    if offset != len(payload):
+        raise ValueError("Trailing bytes in binary request")
+    command["token"] = token
+    return command
+
+def pack_response(resp_type: str, message: str = "", messages: list = None) -> bytes:
+    """
+    Binary response frame. `messages` are in the form a fetch response
+    uses ({"from"/"recipient", "message", "timestamp"}).
+    """
+    parts = [_RESPONSE.pack(RESPONSE_TYPES.index(resp_type)), _pack_str(message or ""),
+             LENGTH.pack(len(messages or ()))]
+    for m in messages or ():
+        if "from" in m:
+            parts.append(b"\x00" + _pack_str(m["from"]))
+        else:
+            parts.append(b"\x01" + _pack_str(m["recipient"]))
+        parts.append(_pack_str(m["message"]))
+        parts.append(_DOUBLE.pack(float(m["timestamp"])))
+    return pack_frame(b"".join(parts))
+
+def unpack_response(payload: bytes) -> DSPResponse:
+    """
+    Decode a binary response payload into a DSPResponse. Messages come
+    back as dicts like the JSON ones, with float timestamps.
+    Raises ValueError if it is malformed.
+    """
+    try:
+        (type_index,) = _RESPONSE.unpack_from(payload, 0)
+        message, offset = _unpack_str(payload, _RESPONSE.size)
+        (count,) = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        messages = []
+        unpack_length, unpack_double = LENGTH.unpack_from, _DOUBLE.unpack_from
+        for _ in range(count):
+            # _unpack_str inlined: this loop is the hot path of a fetch
+            direction = "from" if payload[offset] == 0 else "recipient"
+            (size,) = unpack_length(payload, offset + 1)
+            offset += 5
+            peer = payload[offset:offset + size].decode()
+            offset += size
+            (size,) = unpack_length(payload, offset)
+            offset += 4
+            text = payload[offset:offset + size].decode()
+            offset += size
+            (timestamp,) = unpack_double(payload, offset)
+            offset += 8
+            messages.append({direction: peer, "message": text, "timestamp": timestamp})
+        resp_type = RESPONSE_TYPES[type_index]
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid binary response: {e}") from e
+    return DSPResponse(resp_type, message, None, messages)
+
 def parse_response(json_msg: str) -> DSPResponse:
     """
     Parse any server response JSON string into a DSPResponse.
@@ -74,9 +462,11 @@ def parse_response(json_msg: str) -> DSPResponse:
         raise ValueError("Missing 'response' object in server reply")
 
     resp = obj['response']
-    resp_type = resp.get('type')       # "ok" or "error"
+    resp_type = resp.get('type')       # "ok", "error", "push", "chunk" or "end"
     message   = resp.get('message')    # human-readable info
     token     = resp.get('token')      # only present after authenticate
-    messages  = resp.get('messages')   # only present after fetch
+    messages  = resp.get('messages')   # only present after fetch, in a push or a chunk
+    compress  = resp.get('compress')   # agreed compression, after authenticate
+    encoding  = resp.get('encoding')   # agreed binary encoding, after authenticate
 
-    return DSPResponse(resp_type, message, token, messages)
+    return DSPResponse(resp_type, message, token, messages, compress, encoding)
@@ -1,18 +1,56 @@
 import socket
 import threading
+import asyncio
+import queue
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 import sys
-from datetime import datetime
 import string
 import secrets
+import time
+from collections import OrderedDict
+from ds_storage import BACKENDS, encode_messages_response
+from ds_metrics import ServerMetrics
+from ds_bus import BUS_FILE, BusClient, BusHub
+from ds_protocol import (COMPRESSION, COMPRESS_THRESHOLD, ENCODING_BINARY, LENGTH, compress_frame, decompress_frame,
+                         pack_response, unpack_request)
 
-USERS_PATH = 'users.json'
 STORE_DIR_PATH = 'store'
-DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
+DEBUG = False ##SET THIS TO TRUE (or run with --debug) FOR DEBUGGING OUTPUT. Prints are slow, use the metrics admin command to profile
+STORAGE_WORKERS = 16 ##executor threads used for storage I/O by the asyncio server
+ASYNC_BACKLOG = 1024 ##accept backlog of the asyncio server
+MAX_CONNECTIONS = 256 ##clients served (or, in the threaded server, waiting for a worker) at once, beyond this new clients are rejected
+LISTEN_BACKLOG = 128 ##accept backlog of the threaded server
+OVERLOAD_POLICY = 'queue' ##'queue' waits for a free worker (asyncio: a free connection slot), 'reject' turns the client away when the server is full
+QUEUE_TIMEOUT = 5 ##seconds a queued client waits before it is told the server is busy (None waits for good)
+COMMAND_TYPES = ('authenticate', 'resume', 'directmessage', 'fetch', 'search', 'subscribe', 'admin') ##for per-command metrics
+SESSION_TTL = 600 ##seconds a session outlives its connection, so the client can resume it
+MAX_SESSIONS = 10000 ##detached sessions kept for resume, beyond this the least recently used are dropped
+MAX_FRAME_SIZE = 1024 * 1024 ##largest command (in bytes) a client may send
+RECV_SIZE = 65536
+STREAM_CHUNK = 500 ##messages per frame of a streamed fetch
+PAGE_FIELDS = ('after', 'before', 'limit', 'stream') ##fields of a paged fetch
+SEARCH_FIELDS = ('query', 'contact', 'after', 'before', 'limit') ##fields of a search
+MAX_RECIPIENTS = 1000 ##most recipients of one group directmessage
+MAX_MESSAGE_ID = 64 ##longest client message id of a directmessage
+PROCESSES = os.cpu_count() or 1 ##worker processes of a multi-process server (run_server(processes = ...) or --processes=N)
 
-##The server uses a json files to store data:
-##users - bio's, posts
+##The server stores its data through a ds_storage backend, chosen with backend=:
+##'json' (default, ds_storage.LogStore) keeps everything in memory and persists it as:
+##  users.log - append-only log of every change
+##  users.json - snapshot of all users, rewritten when the log is compacted
+##  archive/ - with retention_days, read messages older than that, moved out of users.json when the log is compacted.
+##             Paged fetches still return them
+##'sqlite' (ds_storage.SQLiteStore) keeps everything in users.db
+##'memory' (ds_storage.MemoryStore) keeps everything in memory only, for benchmarks and tests. With snapshot = True it starts from
+##  users.json and writes it back when the server stops
+##
+##With processes > 1 (DSUCluster) several worker processes accept on the same port, each a complete DSUServer, sharing one store
+##that is safe across processes ('sqlite'). They tell each other about new messages and sessions over a ds_bus Unix socket bus,
+##so pushes reach a subscriber and a session can be resumed whichever worker the client lands on
 
 ##user schema:
 #{user_name: {'password', messages[{'entry','from/recipient', 'timestamp','status'}]
@@ -28,330 +66,1357 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
-users_file_lock = threading.Lock()
+def _is_local(address) -> bool:
+    '''True if a client address belongs to this machine'''
+    return bool(address) and address[0] in ('127.0.0.1', '::1', 'localhost')
+
+def _is_timestamp(value) -> bool:
+    '''True if value is a number, or a string holding one (timestamps travel as strings in the protocol)'''
+    if isinstance(value, bool):
+        return False
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def _is_recipient_list(recipients) -> bool:
+    '''True if recipients is a valid recipient list of a group directmessage: 1 to MAX_RECIPIENTS usernames'''
+    return (isinstance(recipients, list) and 0 < len(recipients) <= MAX_RECIPIENTS
+            and all(isinstance(recipient, str) for recipient in recipients))
+
+def _is_message_id(message_id) -> bool:
+    '''True if message_id is a valid client message id: a non-empty string of at most MAX_MESSAGE_ID characters'''
+    return isinstance(message_id, str) and 0 < len(message_id) <= MAX_MESSAGE_ID
+
+def _is_page_request(args) -> bool:
+    '''True if args is a valid paged fetch: {"after": ts, "before": ts, "limit": n, "stream": bool}, every field optional'''
+    if not args or any(field not in PAGE_FIELDS for field in args):
+        return False
+    if any(field in args and not _is_timestamp(args[field]) for field in ('after', 'before')):
+        return False
+    if 'limit' in args and (isinstance(args['limit'], bool) or not isinstance(args['limit'], int) or args['limit'] < 1):
+        return False
+    return isinstance(args.get('stream', False), bool)
+
+def _is_search_request(args) -> bool:
+    '''True if args is a valid search: {"query": text, "contact": user, "after": ts, "before": ts, "limit": n}, only query required'''
+    if not isinstance(args, dict) or any(field not in SEARCH_FIELDS for field in args):
+        return False
+    if not isinstance(args.get('query'), str) or not args['query'].strip():
+        return False
+    if 'contact' in args and not isinstance(args['contact'], str):
+        return False
+    return _is_page_request({field: args[field] for field in ('after', 'before', 'limit') if field in args} or {'stream': False})
+
+class FrameTooLargeError(Exception):
+    '''Raised when a client sends more than max_frame_size bytes without a line terminator'''
+    pass
+
+class FrameBuffer:
+    '''Per-connection read buffer. Bytes from the socket are fed in as they arrive and complete
+    CRLF terminated frames come out, so a frame may span several reads and one read may hold several frames'''
+    binary = False
+
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        '''Add data to the buffer and return the list of complete frames (without terminators)'''
+        self._buffer += data
+        if b'\n' not in data: ##still inside a partial frame
+            if len(self._buffer) > self.max_frame_size:
+                raise FrameTooLargeError(f'Frame exceeds {self.max_frame_size} bytes')
+            return []
+        *frames, rest = self._buffer.split(b'\n')
+        self._buffer = bytearray(rest)
+        if len(self._buffer) > self.max_frame_size or any(len(frame) > self.max_frame_size + 1 for frame in frames):
+            raise FrameTooLargeError(f'Frame exceeds {self.max_frame_size} bytes')
+        return [bytes(frame).rstrip(b'\r') for frame in frames]
+
+    def switch_to_binary(self):
+        '''The buffer to use once the connection has negotiated the binary encoding, holding whatever is left in this one'''
+        return BinaryFrameBuffer(self.max_frame_size, self._buffer)
+
+class BinaryFrameBuffer:
+    '''Read buffer of a connection using the binary encoding: each frame is a 4 byte length followed by that many bytes of payload'''
+    binary = True
+
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE, data = b''):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(data)
+
+    def feed(self, data):
+        '''Add data to the buffer and return the list of complete frame payloads'''
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= LENGTH.size:
+            (size,) = LENGTH.unpack_from(self._buffer, offset)
+            if size > self.max_frame_size:
+                raise FrameTooLargeError(f'Frame exceeds {self.max_frame_size} bytes')
+            end = offset + LENGTH.size + size
+            if end > len(self._buffer): ##still inside a partial frame
+                break
+            frames.append(bytes(self._buffer[offset + LENGTH.size:end]))
+            offset = end
+        del self._buffer[:offset]
+        return frames
+
+def _push_key(message):
+    '''What tells apart the unread messages queued for push to a connection'''
+    return (message['from'], message['message'], message['timestamp'])
+
+class ClientConnection:
+    '''Per-connection state, shared by the threaded and asyncio servers'''
+    def __init__(self, address, send = None, drain = None):
+        self.address = address
+        self.token = None ##session token once the client has authenticated
+        self.subscribed_user = None ##set while the connection receives pushed messages
+        self.compress = False ##large frames to this client are zlib compressed (negotiated in authenticate or resume)
+        self.binary = False ##frames use the binary encoding of ds_protocol instead of JSON (negotiated in authenticate or resume)
+        self.pushing = set() ##push keys of the messages queued for push to this connection and not yet marked read
+        self._send = send ##writes raw bytes to the client
+        self._drain = drain ##blocks until written bytes have been flushed to the client, if send only queues them
+        self._send_lock = threading.Lock()
+        self._pushes = None ##push frames waiting for the push thread, created with the thread on the first push
+        self._push_lock = threading.Lock()
+
+    def send(self, data):
+        '''Write bytes to the client. Safe to call from any thread, so pushes never interleave with responses'''
+        with self._send_lock:
+            self._send(data)
+
+    def drain(self):
+        '''Wait for the client to take what has been sent, so a long stream never piles up in memory'''
+        if self._drain is not None:
+            self._drain()
+
+    def push(self, frame, keys, on_sent):
+        '''Queue a push frame of the messages with keys. The connection's push thread writes it, so a slow client
+        never holds up the sender, and then calls on_sent. After a failed write nothing more is written and on_sent is not called'''
+        with self._push_lock:
+            if self._pushes is None:
+                self._pushes = queue.SimpleQueue()
+                threading.Thread(target = self._push_loop, args = (self._pushes,), daemon = True).start()
+            self.pushing.update(keys)
+            self._pushes.put((frame, keys, on_sent))
+
+    def stop_pushes(self):
+        '''Let the push thread finish what is already queued and exit'''
+        with self._push_lock:
+            if self._pushes is not None:
+                self._pushes.put(None)
+                self._pushes = None
+
+    def _push_loop(self, pushes):
+        failed = False
+        while True:
+            item = pushes.get()
+            if item is None:
+                return
+            frame, keys, on_sent = item
+            if failed: ##the client missed a frame, so later ones must not be confirmed either
+                continue
+            try:
+                self.send(frame)
+                self.drain()
+            except (OSError, RuntimeError) as e: ##connection (or its event loop) already gone
+                if DEBUG:
+                    print(f'Push to {self.address} failed: {e}')
+                failed = True
+                continue
+            on_sent()
+            self.pushing.difference_update(keys)
+
+class AsyncClientConnection(ClientConnection):
+    '''A connection of the asyncio server. Its pushes are written by a task on the event loop rather than a thread of its own,
+    so subscribed clients cost no more threads than other clients'''
+    def __init__(self, address, loop, writer, executor = None):
+        super().__init__(address, self._send_from_thread, lambda: asyncio.run_coroutine_threadsafe(writer.drain(), loop).result())
+        self._loop = loop
+        self._writer = writer
+        self._executor = executor ##runs on_sent, which touches the store
+        self._push_task = None
+
+    def _send_from_thread(self, data):
+        '''A streamed fetch is produced on an executor thread, so its frames are handed to the loop to write'''
+        if self._writer.is_closing():
+            raise ConnectionResetError('Connection closed')
+        self._loop.call_soon_threadsafe(self._writer.write, data)
+
+    def push(self, frame, keys, on_sent):
+        '''Queue a push frame of the messages with keys for the connection's push task, see ClientConnection.push'''
+        with self._push_lock:
+            self.pushing.update(keys)
+            try:
+                self._loop.call_soon_threadsafe(self._queue, (frame, keys, on_sent))
+            except RuntimeError: ##the event loop has stopped
+                pass
+
+    def stop_pushes(self):
+        try:
+            self._loop.call_soon_threadsafe(self._queue, None)
+        except RuntimeError:
+            pass
+
+    def _queue(self, item):
+        '''On the event loop: hand item to the push task, starting it on the first push'''
+        if item is None:
+            if self._pushes is not None:
+                self._pushes.put_nowait(None)
+                self._pushes = None
+            return
+        if self._pushes is None:
+            self._pushes = asyncio.Queue()
+            self._push_task = self._loop.create_task(self._push_loop(self._pushes))
+        self._pushes.put_nowait(item)
+
+    async def _push_loop(self, pushes):
+        failed = False
+        while True:
+            item = await pushes.get()
+            if item is None:
+                return
+            frame, keys, on_sent = item
+            if failed: ##the client missed a frame, so later ones must not be confirmed either
+                continue
+            try:
+                if self._writer.is_closing():
+                    raise ConnectionResetError('Connection closed')
+                self._writer.write(frame)
+                await self._writer.drain()
+            except (OSError, RuntimeError) as e:
+                if DEBUG:
+                    print(f'Push to {self.address} failed: {e}')
+                failed = True
+                continue
+            await self._loop.run_in_executor(self._executor, on_sent)
+            self.pushing.difference_update(keys)
+
+REMOTE = object() ##Session.conn of a session bound to a connection in another worker process
+
+class Session:
+    '''One authenticated session: the user, the connection it is bound to (None once that connection closes, REMOTE while another worker process has it)
+    and when a detached session expires'''
+    __slots__ = ('user', 'conn', 'expires')
+
+    def __init__(self, user, conn):
+        self.user = user
+        self.conn = conn
+        self.expires = None
+
+class SessionStore:
+    '''Sessions by token. A session is bound to one connection at a time; when that connection closes the session is kept
+    for ttl seconds so a reconnecting client can resume it. Detached sessions are evicted when they expire or, past max_detached, least recently used first'''
+    def __init__(self, ttl = SESSION_TTL, max_detached = MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_detached = max_detached
+        self._sessions = {} ##token -> Session
+        self._detached = OrderedDict() ##token -> Session, oldest detach first (and so soonest to expire)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def user_of(self, token):
+        '''The user of the session token wherever it is bound, or None'''
+        session = self._sessions.get(token)
+        return session.user if session is not None else None
+
+    def create(self, user, conn):
+        '''Start a session for user bound to conn and return its token'''
+        token = generate_token()
+        with self._lock:
+            self._sessions[token] = Session(user, conn)
+        return token
+
+    def user_for(self, token, conn):
+        '''The user of the session token if it is bound to conn, otherwise None'''
+        session = self._sessions.get(token)
+        if session is None or session.conn is not conn:
+            return None
+        return session.user
+
+    def resume(self, token, conn):
+        '''Rebind a live session to conn. Returns (user, previous connection in this process) or (None, None) if the token is unknown or expired'''
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(token)
+            if session is None:
+                return None, None
+            previous = session.conn if session.conn is not REMOTE else None
+            self._detached.pop(token, None)
+            session.conn = conn
+            session.expires = None
+            return session.user, previous
+
+    def release(self, token, conn):
+        '''conn has closed: start the expiry clock of its session (unless the session has since been resumed elsewhere). True if it did'''
+        with self._lock:
+            session = self._sessions.get(token)
+            released = session is not None and session.conn is conn
+            if released:
+                session.conn = None
+                session.expires = time.monotonic() + self.ttl
+                self._detached[token] = session
+            self._evict()
+            return released
+
+    def bind_remote(self, token, user):
+        '''Another worker process started or resumed the session token. Returns the connection in this process it was bound to, if any'''
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                session = self._sessions[token] = Session(user, REMOTE)
+            previous = session.conn if session.conn not in (None, REMOTE) else None
+            self._detached.pop(token, None)
+            session.conn = REMOTE
+            session.expires = None
+            return previous
+
+    def release_remote(self, token, user):
+        '''The connection of the session token in another worker process closed, so it can now be resumed here until it expires'''
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                session = self._sessions[token] = Session(user, REMOTE)
+            if session.conn is REMOTE:
+                session.conn = None
+                session.expires = time.monotonic() + self.ttl
+                self._detached[token] = session
+            self._evict()
+
+    def _evict(self):
+        '''Drop expired detached sessions, then the least recently used ones past max_detached. Called with the lock held'''
+        now = time.monotonic()
+        while self._detached:
+            token, session = next(iter(self._detached.items()))
+            if session.expires > now and len(self._detached) <= self.max_detached:
+                break
+            del self._detached[token]
+            del self._sessions[token]
+
 class DSUServer:
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, store_dir = STORE_DIR_PATH, max_frame_size = MAX_FRAME_SIZE,
+                 workers = None, max_connections = MAX_CONNECTIONS, backlog = None, overload_policy = OVERLOAD_POLICY, queue_timeout = QUEUE_TIMEOUT,
+                 backend = 'json', profile = False, session_ttl = SESSION_TTL, max_sessions = MAX_SESSIONS,
+                 compress_threshold = COMPRESS_THRESHOLD, reuse_port = False, listen_socket = None, bus_path = None,
+                 retention_days = None, snapshot = False):
+        if overload_policy not in ('queue', 'reject'):
+            raise ValueError(f'Unknown overload policy: {overload_policy}')
+        if retention_days is not None and not BACKENDS[backend].archives:
+            raise ValueError(f'The {backend} backend has no archive for a retention period, use json')
         self.host = host
         self.port = port
-        self.sessions = {} ##token -> user
+        self.max_frame_size = max_frame_size
+        self.compress_threshold = compress_threshold ##frames shorter than this are never compressed
+        ##threads serving clients in the threaded server. A client holds its thread until it disconnects, so this caps the clients served
+        ##at once and the rest queue or are rejected (see overload_policy). By default there is one for every connection max_connections allows
+        self.workers = workers if workers is not None else max_connections
+        self.max_connections = max_connections
+        self.backlog = backlog ##accept backlog, by default LISTEN_BACKLOG for the threaded server and ASYNC_BACKLOG for the asyncio one
+        self.overload_policy = overload_policy
+        self.queue_timeout = queue_timeout
+        self.pending = queue.Queue() ##accepted connections waiting for a worker, each with the lock a worker or its queue timeout takes to claim it
+        self.open_connections = 0 ##admitted clients, being served or waiting for a worker
+        self.connection_stats = {'accepted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+        self._stats_lock = threading.Lock()
+        self._slot_freed = None ##asyncio.Condition that queued clients of the asyncio server wait on, created on the event loop
+        if snapshot and backend != 'memory':
+            raise ValueError(f'The {backend} backend is already persistent, snapshot is for the memory backend')
+        options = {}
+        if retention_days is not None: ##read messages older than retention_days move to the store's cold archive
+            options['retention_days'] = retention_days
+        if snapshot:
+            options['snapshot'] = True
+        self.store = BACKENDS[backend](store_dir, **options)
+        self.sessions = SessionStore(session_ttl, max_sessions)
         self.clients = []
+        self.executor = None ##storage executor of the asyncio server
+        self.subscribers = {} ##user -> set of connections that receive pushed messages
+        self._subscribers_lock = threading.Lock()
+        self._push_locks = {} ##user -> lock that keeps pushes to that user in order
+        self.metrics = ServerMetrics()
+        self.set_profiling(profile)
+        self.ready = threading.Event() ##set once the server is listening (self.port then holds the real port)
+        self._running = False
+        self._loop = None ##event loop and listener of the asyncio server
+        self._async_server = None
+        ##as one worker process of a DSUCluster: listen with SO_REUSEPORT or on a socket shared by the workers, and join the bus at bus_path
+        self.reuse_port = reuse_port
+        self.listen_socket = listen_socket
+        self.bus_path = bus_path
+        self.bus = None
     
     def handle_client(self, client_socket, client_address):
 
         '''Handle requests from a single client'''
-        current_user_token = None   
+        conn = ClientConnection(client_address, client_socket.sendall)
+        frames = FrameBuffer(self.max_frame_size)
         self.clients.append(client_socket)
+        self.metrics.connection_opened()
         try:
             while True:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(RECV_SIZE)
                 if DEBUG:
                     print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
-                msg = data.decode().strip() 
-                if not msg:
+                if not data:
                     if DEBUG:
                         print("Connection closed.")
                     break
+                if self.metrics.enabled:
+                    self.metrics.add_bytes(inbound = len(data))
                 try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else: 
-                    message = ""
+                    conn.send(self.handle_frames(frames.feed(data), conn, frames.binary))
+                except FrameTooLargeError:
+                    conn.send(self._frame_too_large_response(conn))
+                    break
+                if conn.binary and not frames.binary:
+                    frames = frames.switch_to_binary()
+        except Exception as e:
+            if self._running or DEBUG: ##while stopping, errors from closed sockets are expected
+                print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._end_session(conn)
+            client_socket.close()
+            if client_socket in self.clients:
+                self.clients.remove(client_socket)
+            self.metrics.connection_closed()
+
+    async def handle_async_client(self, reader, writer):
+        '''Handle requests from a single client on the asyncio event loop. Command handling (and with it all storage I/O) runs in the executor'''
+        client_address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        if not await self._admit_async(writer, client_address):
+            return
+        conn = AsyncClientConnection(client_address, loop, writer, self.executor)
+        frames = FrameBuffer(self.max_frame_size)
+        self.metrics.connection_opened()
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if DEBUG:
+                    print(f"Message received by server: {repr(data)}")
+                if not data:
+                    if DEBUG:
+                        print("Connection closed.")
+                    break
+                if self.metrics.enabled:
+                    self.metrics.add_bytes(inbound = len(data))
+                try:
+                    complete = frames.feed(data)
+                except FrameTooLargeError:
+                    writer.write(self._frame_too_large_response(conn))
+                    await writer.drain()
+                    break
+                if complete:
+                    response = await loop.run_in_executor(self.executor, self.handle_frames, complete, conn, frames.binary)
+                    writer.write(response)
+                    await writer.drain()
+                    if conn.binary and not frames.binary:
+                        frames = frames.switch_to_binary()
+        except asyncio.CancelledError: ##server shutting down
+            pass
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._end_session(conn)
+            writer.close()
+            self.metrics.connection_closed()
+            async with self._slot_freed:
+                with self._stats_lock:
+                    self.open_connections -= 1
+                self._slot_freed.notify()
+
+    def handle_frames(self, frames, conn, binary = False):
+        '''Execute every complete frame from one read, in order, and return all responses as one buffer so pipelined requests are answered with a single write.
+        binary tells whether the frames came from a BinaryFrameBuffer'''
+        responses = []
+        for frame in frames:
+            if binary:
+                try:
+                    response = self.handle_request(None, conn, unpack_request(frame))
+                except ValueError:
+                    response = pack_response('error', 'Incorrectly formatted binary message.')
+            else:
+                msg = frame.decode(errors = 'replace').strip()
+                if not msg: ##blank lines are ignored
+                    continue
+                response = self.handle_request(msg, conn)
+            if isinstance(response, bytes):
+                responses.append(response)
+                continue
+            ##a streamed fetch: write the responses before it, then each frame of the stream as it is produced
+            for chunk in response:
+                data = b''.join(responses) + chunk
+                responses = []
+                conn.send(data)
+                conn.drain()
+                if self.metrics.enabled:
+                    self.metrics.add_bytes(outbound = len(data))
+        response = b''.join(responses)
+        if self.metrics.enabled:
+            self.metrics.add_bytes(outbound = len(response))
+        return response
+
+    def _frame_too_large_response(self, conn):
+        message = f'Message exceeds the maximum size of {self.max_frame_size} bytes.'
+        if conn.binary:
+            return pack_response('error', message)
+        resp = {'response': {'type': 'error', 'message': message}}
+        return json.dumps(resp).encode() + b'\r\n'
+
+    def handle_request(self, msg, conn, command = None):
+        '''Execute one command received on the connection conn and return the encoded response line
+        (for a streamed fetch, an iterator over its frames). Shared by the threaded and asyncio servers.
+        A command already decoded from a binary frame is passed as command instead of msg'''
+        started = time.perf_counter() if self.metrics.enabled else None
+        current_user_token = conn.token
+        stream = None
+        compression = None ##set when this command negotiates compression
+        encoding = None ##set when this command negotiates the binary encoding
+        direct_message_read = False
+        direct_message_sent = False
+        subscription_changed = False
+        admin_command = False
+        metrics_report = None
+
+        try:
+            if command is None:
+                command = json.loads(decompress_frame(msg.strip(), self.max_frame_size))
+        except ValueError: ##not JSON, or a compressed frame that does not decode
+            message = 'Incorrectly formatted JSON message.'
+            status = 'error'
+        else: 
+            message = ""
+            status = "error"
+            
+            if 'authenticate' in command:
+                
+                if len(command) != 1: 
+                    status = "error"
+                    message = "Incorrectly formatted authenticate command."
+                elif any(field not in ('username', 'password', 'compress', 'encoding') for field in command['authenticate']):
+                    status = "error"
+                    message = "Extra fields provided to authenticate command object."
+                elif not all(field in command['authenticate'] for field in ['username', 'password']):
                     status = "error"
+                    message = "Missing required fields for authenticate command object."
+                elif current_user_token:
+                    status = "error"
+                    message = "User already authenticated on the active session."
+                else:
+                    ##execute authenticate command
+                    
+                    uname = command['authenticate']['username']
+                    password = command['authenticate']['password']
+                    
                     
-                    if 'authenticate' in command:
+                    fetched_user = self._get_or_create_new_user(uname, password)
+
+                    if not fetched_user:
+                        message = f'Welcome to ICS32 Distributed Social, {uname}!'
+                        status = 'ok'
+                        current_user_token = self.sessions.create(uname, conn)
+
                         
-                        if len(command) != 1: 
-                            status = "error"
-                            message = "Incorrectly formatted authenticate command."
-                        elif len(command['authenticate']) > 2:
-                            status = "error"
-                            message = "Extra fields provided to authenticate command object."
-                        elif not all(field in command['authenticate'] for field in ['username', 'password']):
-                            status = "error"
-                            message = "Missing required fields for authenticate command object."
-                        elif current_user_token:
+                    else:
+                        if fetched_user['password'] != password:
                             status = "error"
-                            message = "User already authenticated on the active session."
-                        else:
-                            ##execute authenticate command
+                            message = f'Incorrect password for the user {uname}'
                             
-                            uname = command['authenticate']['username']
-                            password = command['authenticate']['password']
-                            
-                            
-                            fetched_user = self._get_or_create_new_user(uname, password)
-
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
-
-                                
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {uname}'
-                                    current_user_token = None
-                                    
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
-                    
-                    ###direct message handling
-                    elif 'directmessage' in command:
-                        
-                        args = command['directmessage']
-
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
-                            status = 'error'
-                        elif isinstance(args, dict) and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
-                            status = 'error'
                         else:
-                            token = command['token']
-                            recipient = args['recipient']
-                            #timestamp = args['timestamp']
-                            timestamp = str((datetime.now().timestamp()))
-                            entry = args['entry']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_sent = True
-                                    
-                                if self._send_message(entry,current_user, recipient, timestamp):
-                                    message = f'Direct message sent'
-                                    status = 'ok'
-                                else:
-                                    message = f'Unable to send direct message'
-                                    status = 'error'
-                            else:
-                                message = 'Invalid user token.'
-                                status = 'error'
-                            
-                    elif 'fetch' in command:
-                        args = command['fetch']
-                        token = command['token']
-                        if args == 'all':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_all_messages(current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
-                        elif args == 'unread':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_unread_messages(current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
+                            status = "ok"
+                            message = f'Welcome back, {uname}!'
+                            current_user_token = self.sessions.create(uname, conn)
+                    if status == 'ok':
+                        compression, encoding = self._negotiate(command['authenticate'])
+                        self._publish({'op': 'bind', 'token': current_user_token, 'user': uname})
 
+            elif 'resume' in command:
+                ##{"resume": {"token": ...}} rebinds a session left by a closed connection to this one, instead of authenticating again
+                args = command['resume']
+                if len(command) != 1 or not isinstance(args, dict) or 'token' not in args or any(field not in ('token', 'compress', 'encoding') for field in args):
+                    status = "error"
+                    message = "Incorrectly formatted resume command."
+                elif current_user_token:
+                    status = "error"
+                    message = "User already authenticated on the active session."
+                else:
+                    uname, previous = self.sessions.resume(args['token'], conn)
+                    if uname is None:
+                        status = "error"
+                        message = "Invalid or expired session token."
+                    else:
+                        if previous is not None: ##the old connection may still be open, it stops receiving pushes
+                            self._unsubscribe(previous)
+                        current_user_token = args['token']
+                        status = "ok"
+                        message = f'Welcome back, {uname}!'
+                        compression, encoding = self._negotiate(args)
+                        self._publish({'op': 'bind', 'token': current_user_token, 'user': uname})
+            
+            ###direct message handling
+            elif 'directmessage' in command:
+                
+                args = command['directmessage']
+
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted directmessage command."
+                    status = 'error'
+                elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == (4 if 'message_id' in args else 3)):
+                    message = "Incorrect fields provided to directmessage command object."
+                    status = 'error'
+                elif isinstance(args, dict) and 'message_id' in args and not _is_message_id(args['message_id']):
+                    ##optional client message id: a retried send with the same id is acknowledged but stored only once
+                    message = f'A directmessage message_id must be a string of 1 to {MAX_MESSAGE_ID} characters.'
+                    status = 'error'
+                elif isinstance(args, dict) and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
+                    message = "Missing required fields for directmessage command."
+                    status = 'error'
+                elif isinstance(args, dict) and isinstance(args['recipient'], list) and not _is_recipient_list(args['recipient']):
+                    ##a group directmessage: "recipient" is a list of usernames, stored once for all of them
+                    message = f'A group directmessage needs 1 to {MAX_RECIPIENTS} recipients.'
+                    status = 'error'
+                elif isinstance(args, dict) and not isinstance(args['recipient'], (str, list)):
+                    message = 'A directmessage recipient must be a username or a list of usernames.'
+                    status = 'error'
+                elif isinstance(args, dict) and not isinstance(args['entry'], str):
+                    message = 'A directmessage entry must be a string.'
+                    status = 'error'
+                else:
+                    token = command['token']
+                    recipient = args['recipient']
+                    #timestamp = args['timestamp'] ##the store assigns the timestamp
+                    entry = args['entry']
+                    current_user = self._session_user(token, conn)
+                    if current_user:
+                        direct_message_sent = True
+                            
+                        if self._send_message(entry,current_user, recipient, message_id = args.get('message_id')):
+                            message = f'Direct message sent'
+                            status = 'ok'
                         else:
-                            message = 'Invalid argument for fetch field.'
+                            message = f'Unable to send direct message'
                             status = 'error'
-
                     else:
-                        message = 'Invalid command.'
+                        message = 'Invalid user token.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type':status, 'messages': message} }
-                elif direct_message_sent:
-                    resp = {'response': {'type':status, 'message': message} }
-                elif status == 'ok':
-                    resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+                    
+            elif 'fetch' in command:
+                args = command['fetch']
+                token = command['token']
+                if args == 'all':
+                    current_user = self._session_user(token, conn)
+                    if current_user:
+                        direct_message_read = True
+                        message = self._read_all_messages(current_user)
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+                elif args == 'unread':
+                    current_user = self._session_user(token, conn)
+                    if current_user:
+                        direct_message_read = True
+                        message = self._read_unread_messages(current_user)
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+                elif isinstance(args, dict) and list(args) == ['since'] and _is_timestamp(args['since']):
+                    ##incremental fetch: only messages newer than the client's cursor
+                    current_user = self._session_user(token, conn)
+                    if current_user:
+                        direct_message_read = True
+                        message = self._read_messages_since(current_user, float(args['since']))
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+                elif isinstance(args, dict) and _is_page_request(args):
+                    ##paged fetch, read status untouched. With "stream": true every match is sent in frames of STREAM_CHUNK messages and an end frame
+                    current_user = self._session_user(token, conn)
+                    if current_user:
+                        after = float(args['after']) if 'after' in args else None
+                        before = float(args['before']) if 'before' in args else None
+                        status = 'ok'
+                        if args.get('stream'):
+                            stream = self._stream_messages(current_user, after, before, args.get('limit'))
+                        else:
+                            direct_message_read = True
+                            message = self._read_message_page(current_user, after, before, args.get('limit'))
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+
                 else:
-                    resp = {'response': {'type':status, 'message': message}}
+                    message = 'Invalid argument for fetch field.'
+                    status = 'error'
+
+            elif 'search' in command:
+                ##{"token": ..., "search": {"query": "words", "contact": user, "after": ts, "before": ts, "limit": n}}, read status untouched
+                args = command['search']
+                if not _is_search_request(args):
+                    message = 'Invalid argument for search field.'
+                    status = 'error'
+                elif 'token' in command and self._session_user(command['token'], conn):
+                    current_user = self._session_user(command['token'], conn)
+                    direct_message_read = True
+                    after = float(args['after']) if 'after' in args else None
+                    before = float(args['before']) if 'before' in args else None
+                    message = self._search_messages(current_user, args['query'], args.get('contact'), after, before, args.get('limit'))
+                    status = 'ok'
+                else:
+                    message = 'Invalid user token.'
+                    status = 'error'
+
+            elif 'subscribe' in command:
+                ##{"token": ..., "subscribe": true|false} turns pushing of new direct messages on or off
+                if 'token' not in command or len(command) != 2 or not isinstance(command['subscribe'], bool):
+                    message = 'Incorrectly formatted subscribe command.'
+                    status = 'error'
+                elif self._session_user(command['token'], conn):
+                    subscription_changed = True
+                    status = 'ok'
+                    if command['subscribe']:
+                        self._subscribe(conn, self._session_user(command['token'], conn))
+                        message = 'Subscribed to new direct messages.'
+                    else:
+                        self._unsubscribe(conn)
+                        message = 'Unsubscribed from new direct messages.'
+                else:
+                    message = 'Invalid user token.'
+                    status = 'error'
+
+            elif 'admin' in command:
+                ##{"admin": "metrics" | "profile-on" | "profile-off" | "reset-metrics"}, only from this machine
+                action = command['admin']
+                admin_command = True
+                if not _is_local(conn.address):
+                    message = 'Admin commands are only accepted from localhost.'
+                    status = 'error'
+                elif action == 'metrics':
+                    metrics_report = self.metrics_report()
+                    message = 'Server metrics'
+                    status = 'ok'
+                elif action in ('profile-on', 'profile-off'):
+                    self.set_profiling(action == 'profile-on')
+                    message = f'Profiling {"enabled" if self.metrics.enabled else "disabled"}.'
+                    status = 'ok'
+                elif action == 'reset-metrics':
+                    self.metrics.reset()
+                    message = 'Metrics reset.'
+                    status = 'ok'
+                else:
+                    message = 'Invalid admin command.'
+                    status = 'error'
+
+            else:
+                message = 'Invalid command.'
+                status = 'error'
+        if DEBUG:
+            print(f'Server sending the following message: "{message}"')
+        json_response = None
+        if direct_message_read and status == 'ok' and isinstance(message, list):
+            ##assembled from the messages' cached encodings where the store has them
+            json_response = encode_messages_response(status, message)
+        elif direct_message_read:
+            resp = {'response': {'type':status, 'messages': message} }
+        elif metrics_report is not None:
+            resp = {'response': {'type':status, 'message': message, 'metrics': metrics_report} }
+        elif direct_message_sent or subscription_changed or admin_command:
+            resp = {'response': {'type':status, 'message': message} }
+        elif status == 'ok':
+            resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+            if compression:
+                resp['response']['compress'] = compression
+            if encoding:
+                resp['response']['encoding'] = encoding
+        else:
+            resp = {'response': {'type':status, 'message': message}}
+        conn.token = current_user_token
+        if stream is not None:
+            json_response = self._stream_frames(stream, conn)
+        elif conn.binary:
+            messages = message if direct_message_read and isinstance(message, list) else None
+            json_response = pack_response(status, message if isinstance(message, str) else '', messages)
+        else:
+            if json_response is None:
                 json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
-        except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self.clients.remove(client_socket)
-            
-    def _send_message(self, entry, username, recipient, timestamp = ''):
-        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-            
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
-            
+            json_response = self._encode_frame(json_response, conn)
+        ##the reply that agrees to compress or switch encoding is itself sent plain JSON
+        if compression:
+            conn.compress = True
+        if encoding:
+            conn.binary = True
+        if started is not None:
+            kind = next((k for k in COMMAND_TYPES if k in command), 'invalid') if isinstance(command, dict) else 'invalid'
+            self.metrics.record_command(kind, time.perf_counter() - started)
+        return json_response
+
+    def _negotiate(self, args):
+        '''The compression and encoding an authenticate or resume command asks for and the server agrees to. Binary frames are never compressed'''
+        if args.get('encoding') == ENCODING_BINARY:
+            return None, ENCODING_BINARY
+        if args.get('compress') == COMPRESSION:
+            return COMPRESSION, None
+        return None, None
+
+    def _stream_frames(self, stream, conn):
+        '''Encode the pages of a streamed fetch for conn: a chunk frame per page, then the end frame'''
+        sent = 0
+        for page in stream:
+            sent += len(page)
+            if conn.binary:
+                yield pack_response('chunk', '', page)
             else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
+                yield self._encode_frame(encode_messages_response('chunk', page), conn)
+        message = f'{sent} messages sent.'
+        if conn.binary:
+            yield pack_response('end', message)
+        else:
+            yield self._encode_frame(json.dumps({'response': {'type': 'end', 'message': message}}).encode(), conn)
+
+    def _encode_frame(self, body, conn):
+        '''Terminate an encoded response for conn, compressing it if the client asked for that and it is large enough'''
+        if conn.compress:
+            body = compress_frame(body, self.compress_threshold)
+        return body + b'\r\n'
+
+    def set_profiling(self, enabled):
+        '''Turn metrics collection (including storage lock timing) on or off at runtime'''
+        self.metrics.enabled = enabled
+        if hasattr(self.store, 'lock_observer'):
+            self.store.lock_observer = self.metrics.record_lock if enabled else None
+
+    def metrics_report(self):
+        '''Current metrics plus session and admission counters, as a dict'''
+        report = self.metrics.snapshot()
+        report['sessions'] = len(self.sessions)
+        report['pid'] = os.getpid() ##which worker process answered, when there are several
+        report['subscribers'] = len(self.subscribers)
+        with self._stats_lock:
+            report['admission'] = dict(self.connection_stats, open = self.open_connections)
+        return report
+
+    def _session_user(self, token, conn):
+        '''The user of token, if it is the session of this connection'''
+        if token != conn.token:
+            return None
+        return self.sessions.user_for(token, conn)
+
+    def _end_session(self, conn):
+        '''Detach the session of a connection that has closed. It can be resumed until it expires'''
+        self._unsubscribe(conn)
+        if conn.token and self.sessions.release(conn.token, conn):
+            self._publish({'op': 'release', 'token': conn.token, 'user': self.sessions.user_of(conn.token)})
+
+    def _publish(self, event):
+        '''Tell the other worker processes about event, when running as one (see DSUCluster)'''
+        if self.bus is not None:
+            self.bus.publish(event)
+
+    def _on_bus_event(self, event):
+        '''An event published by another worker process: a session started, resumed or detached there,
+        users got new messages (push them if subscribed here), or messages another worker queued for push (push them here too)'''
+        op = event['op']
+        if op == 'bind':
+            previous = self.sessions.bind_remote(event['token'], event['user'])
+            if previous is not None: ##resumed elsewhere, the old connection here stops receiving pushes
+                self._unsubscribe(previous)
+        elif op == 'release':
+            self.sessions.release_remote(event['token'], event['user'])
+        elif op == 'new':
+            for username in event['users']:
+                self._push_new_messages(username)
+        elif op == 'push':
+            self._deliver_push(event['user'], event['messages'])
+
+    def _subscribe(self, conn, username):
+        '''Start pushing new messages for username to conn. Anything still unread is pushed right away so the client starts from a clean slate'''
+        self._unsubscribe(conn)
+        with self._subscribers_lock:
+            self.subscribers.setdefault(username, set()).add(conn)
+            conn.subscribed_user = username
+        self._push_new_messages(username)
+
+    def _unsubscribe(self, conn):
+        with self._subscribers_lock:
+            username = conn.subscribed_user
+            if username is None:
+                return
+            conn.subscribed_user = None
+            targets = self.subscribers.get(username, set())
+            targets.discard(conn)
+            if not targets:
+                self.subscribers.pop(username, None)
+        conn.stop_pushes()
+
+    def _push_new_messages(self, username):
+        '''Queue the unread messages of username for push to its subscribed connections. They stay unread until written
+        (see _queue_push), so other worker processes are sent them for their subscribers of username'''
+        if username not in self.subscribers:
+            return
+        with self._push_locks.setdefault(username, threading.Lock()):
+            with self._subscribers_lock:
+                targets = list(self.subscribers.get(username, ()))
+            if not targets:
+                return
+            messages = self.store.read_unread(username, mark = False)
+            if not messages:
+                return
+            self._publish({'op': 'push', 'user': username, 'messages': messages})
+            self._push_to(targets, username, messages)
+
+    def _deliver_push(self, username, messages):
+        '''Push messages queued by another worker process to the subscribed connections of username'''
+        if username not in self.subscribers:
+            return
+        with self._push_locks.setdefault(username, threading.Lock()):
+            with self._subscribers_lock:
+                targets = list(self.subscribers.get(username, ()))
+            self._push_to(targets, username, messages)
+
+    def _push_to(self, targets, username, messages):
+        '''Queue to each connection in targets those of messages it does not have queued already'''
+        batches = {} ##indexes of the messages not queued to a connection yet -> those connections
+        for conn in targets:
+            pending = tuple(i for i, m in enumerate(messages) if _push_key(m) not in conn.pushing)
+            if pending:
+                batches.setdefault(pending, []).append(conn)
+        for pending, conns in batches.items():
+            self._queue_push(conns, username, [messages[i] for i in pending])
+
+    def _queue_push(self, targets, username, messages):
+        '''Queue one push frame of messages to each connection in targets. The messages are marked read
+        once the frame has been written, so a push that never reaches the client leaves them unread'''
+        keys = {_push_key(m) for m in messages}
+        frames = {} ##encoded once per encoding and compress setting
+        for conn in targets:
+            frame = frames.get((conn.binary, conn.compress))
+            if frame is None:
+                if conn.binary:
+                    frame = pack_response('push', '', messages)
+                else:
+                    frame = self._encode_frame(encode_messages_response('push', messages), conn)
+                frames[conn.binary, conn.compress] = frame
+            if self.metrics.enabled:
+                self.metrics.add_bytes(outbound = len(frame))
+            conn.push(frame, keys, lambda: self.store.mark_read(username, messages))
+
+    def _send_message(self, entry, username, recipient, timestamp = None, message_id = None):
+        '''Sends a message from one user (username) to another (recipient), or to each user in a list of recipients in one storage operation.
+        Creates the message in the user's associated object and pushes it straight to the recipients that are subscribed.
+        A message_id the user already sent is acknowledged without storing the message again'''
+        recipients = recipient if isinstance(recipient, list) else [recipient]
+        if isinstance(recipient, list):
+            stored = self.store.add_group_message(entry, username, recipients, timestamp, message_id)
+        else:
+            stored = self.store.add_message(entry, username, recipient, timestamp, message_id)
+        if not stored:
+            return False
+        for recipient in recipients:
+            self._push_new_messages(recipient)
+        self._publish({'op': 'new', 'users': recipients})
         return True
 
     def _read_all_messages(self, username):
         '''Retrieves all messages associated with a user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'unread':
-                    message['status'] = 'read'
-
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        return self.store.read_all(username)
 
-    
     def _read_unread_messages(self, username):
         '''Retrieves unread messages associated with the user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'unread':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
-            
-            
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        return self.store.read_unread(username)
+
+    def _read_messages_since(self, username, since):
+        '''Retrieves the messages associated with the user that are newer than the timestamp since'''
+        return self.store.read_since(username, since)
+
+    def _read_message_page(self, username, after, before, limit):
+        '''Retrieves one page of the messages associated with the user, see Storage.read_page'''
+        return self.store.read_page(username, after, before, limit)
+
+    def _search_messages(self, username, query, contact, after, before, limit):
+        '''Retrieves the messages associated with the user that contain every word of query, see Storage.search'''
+        return self.store.search(username, query, contact, after, before, limit)
+
+    def _stream_messages(self, username, after, before, limit):
+        '''Yield the messages of the user between after and before (at most limit of them, oldest first) one page of up to STREAM_CHUNK at a time.
+        One page is read from the store per frame, so neither side ever holds the whole mailbox'''
+        after = float('-inf') if after is None else after ##always page forwards
+        sent = 0
+        while limit is None or sent < limit:
+            size = STREAM_CHUNK if limit is None else min(STREAM_CHUNK, limit - sent)
+            page = self._read_message_page(username, after, before, size)
+            if not page:
+                break
+            sent += len(page)
+            after = float(page[-1]['timestamp']) ##timestamps are unique per mailbox
+            yield page
+            if len(page) < size:
+                break
 
     def _get_user(self, username):
 
         '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
-    
-
+        return self.store.get_user(username)
 
     def _get_or_create_new_user(self, username, password):
 
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        '''Get the user associated with the username (only its password, from the store's in-memory user directory). If it doesnt exist, create a new user.'''
+        stored_password = self.store.get_password(username)
+        if stored_password is not None:
+            return {'password': stored_password}
+        if not self.store.create_user(username, password):
+            ##another client created the user between the lookup and create_user: this is a returning user, check its password
+            return {'password': self.store.get_password(username)}
 
-            fetched_user = existing_users.get(username, None)
-            if fetched_user:
-                return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
-            
-        
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
+        '''Creates the local storage system if it doesnt already exist and loads it. Will create a directory called "store" holding the backend's files.
+        A worker process of a DSUCluster also joins the bus here'''
+        self.store.open()
+        if self.bus_path is not None and self.bus is None:
+            self.bus = BusClient(self.bus_path, self._on_bus_event)
+            self.bus.connect()
+
+    def _close_storage_system(self):
+        '''Leave the bus and close the store'''
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+        self.store.close()
+
+    def _listen_socket(self):
+        '''The listening socket of the threaded server: the one shared by the worker processes of a DSUCluster, or a new one'''
+        if self.listen_socket is not None:
+            return self.listen_socket
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port: ##every worker process binds the same port, the kernel spreads connections over them
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        srv.bind((self.host, self.port))
+        srv.listen(self.backlog if self.backlog is not None else LISTEN_BACKLOG)
+        return srv
 
     def start_server(self):
         '''Starts the server (hence the name of the method :))'''
         self._create_storage_system() #does nothing if the server store files exists already
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
-                srv.bind((self.host, self.port))
-                srv.listen(5)
+            with self._listen_socket() as srv:
+                self.port = srv.getsockname()[1]
+                for _ in range(self.workers):
+                    threading.Thread(target = self._worker_loop, daemon = True).start()
                 if DEBUG:
                     print("DSUserver is listening on port", self.port)
-                while True:
+                self._running = True
+                self.ready.set()
+                while self._running:
                     connection, address = srv.accept()
-                    client_handler = threading.Thread(target = self.handle_client, args = (connection,address))
-                    client_handler.start()
+                    if not self._running: ##woken up by shutdown()
+                        connection.close()
+                        break
+                    self._admit(connection, address)
         except KeyboardInterrupt as e:
             if DEBUG:
                 print(f'Server shutting down...')
         finally:
-            for conn in self.clients:
+            self._running = False
+            for _ in range(self.workers):
+                self.pending.put(None) ##lets each worker thread exit
+            for conn in list(self.clients):
                 conn.close()
-            self.clients = []
+            self.clients.clear()
+            self._close_storage_system()
+            self.ready.clear()
             if DEBUG:
                 print('Disconnected all clients.')
 
-        
-def run_server(host = '127.0.0.1', port1 = 3001):
-    try:
-        server = DSUServer(host, port1)
+    def _admit(self, connection, address):
+        '''Hand an accepted connection to the worker pool, or turn it away if the server is at capacity.
+        A connection that has to queue is turned away too if no worker frees up within queue_timeout'''
+        with self._stats_lock:
+            busy = self.open_connections >= self.workers
+            if self.open_connections >= self.max_connections or (busy and self.overload_policy == 'reject'):
+                self.connection_stats['rejected'] += 1
+                admitted = False
+            else:
+                self.connection_stats['accepted'] += 1
+                if busy:
+                    self.connection_stats['queued'] += 1
+                self.open_connections += 1
+                admitted = True
+        if admitted:
+            claim = threading.Lock()
+            self.pending.put((connection, address, claim))
+            if busy and self.queue_timeout is not None:
+                timer = threading.Timer(self.queue_timeout, self._expire, (connection, address, claim))
+                timer.daemon = True
+                timer.start()
+            return
+        self._turn_away(connection, address)
+
+    def _expire(self, connection, address, claim):
+        '''Turn away a queued connection that no worker has taken within queue_timeout'''
+        if not claim.acquire(blocking = False): ##a worker got to it first
+            return
+        with self._stats_lock:
+            self.open_connections -= 1
+            self.connection_stats['timed_out'] += 1
+        self._turn_away(connection, address)
+
+    async def _admit_async(self, writer, address):
+        '''Admission control of the asyncio server, which serves max_connections clients at once. Beyond that a client is turned away,
+        or with the 'queue' policy first waits up to queue_timeout for another client to leave. Returns whether the client was admitted'''
+        if self._slot_freed is None:
+            self._slot_freed = asyncio.Condition()
+        async with self._slot_freed:
+            busy = self.open_connections >= self.max_connections
+            with self._stats_lock:
+                if busy and self.overload_policy == 'reject':
+                    self.connection_stats['rejected'] += 1
+                else:
+                    self.connection_stats['accepted'] += 1
+                    if busy:
+                        self.connection_stats['queued'] += 1
+            admitted = not busy
+            if busy and self.overload_policy == 'queue':
+                try:
+                    await asyncio.wait_for(self._slot_freed.wait_for(lambda: self.open_connections < self.max_connections),
+                                           self.queue_timeout)
+                    admitted = True
+                except asyncio.TimeoutError:
+                    with self._stats_lock:
+                        self.connection_stats['timed_out'] += 1
+            if admitted:
+                with self._stats_lock:
+                    self.open_connections += 1
+        if not admitted:
+            if DEBUG:
+                print(f'Rejecting client {address}: server overloaded')
+            try:
+                writer.write(self._busy_response())
+                await writer.drain()
+            except OSError:
+                pass
+            finally:
+                writer.close()
+        return admitted
+
+    def _busy_response(self):
+        resp = {'response': {'type': 'error', 'message': 'Server is busy, try again later.'}}
+        return json.dumps(resp).encode() + b'\r\n'
+
+    def _turn_away(self, connection, address):
+        '''Tell a client the server is busy and close its connection'''
+        if DEBUG:
+            print(f'Rejecting client {address}: server overloaded')
+        try:
+            connection.sendall(self._busy_response())
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def _worker_loop(self):
+        '''Body of a pool thread: serve queued connections one at a time, forever'''
+        while True:
+            item = self.pending.get()
+            if item is None: ##server stopped
+                return
+            connection, address, claim = item
+            if not claim.acquire(blocking = False): ##timed out in the queue, already turned away
+                continue
+            try:
+                self.handle_client(connection, address)
+            finally:
+                with self._stats_lock:
+                    self.open_connections -= 1
+
+    def start_async_server(self):
+        '''Starts the server on an asyncio event loop: one coroutine per client instead of one thread, storage I/O in a small thread pool'''
+        self._create_storage_system()
+        self.executor = ThreadPoolExecutor(max_workers = STORAGE_WORKERS)
+        try:
+            asyncio.run(self._serve_async())
+        except KeyboardInterrupt as e:
+            if DEBUG:
+                print(f'Server shutting down...')
+        finally:
+            self._running = False
+            self._loop = None
+            self.executor.shutdown(wait = True)
+            self._close_storage_system()
+            self.ready.clear()
+            if DEBUG:
+                print('Disconnected all clients.')
+
+    async def _serve_async(self):
+        backlog = self.backlog if self.backlog is not None else ASYNC_BACKLOG
+        if self.listen_socket is not None:
+            srv = await asyncio.start_server(self.handle_async_client, sock = self.listen_socket, backlog = backlog)
+        else:
+            srv = await asyncio.start_server(self.handle_async_client, self.host, self.port, backlog = backlog,
+                                             reuse_port = self.reuse_port or None)
+        self.port = srv.sockets[0].getsockname()[1]
+        self._loop = asyncio.get_running_loop()
+        self._async_server = srv
+        if DEBUG:
+            print("DSUserver (asyncio) is listening on port", self.port)
+        self._running = True
+        self.ready.set()
+        try:
+            await srv.serve_forever()
+        except asyncio.CancelledError: ##closed by shutdown()
+            pass
+        finally:
+            srv.close() ##open client connections are cancelled when the loop ends
+
+    def shutdown(self):
+        '''Stop a running server from another thread. start_server / start_async_server return once it has stopped'''
+        if not self._running:
+            return
+        self._running = False
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_server.close)
+        else:
+            try: ##wake the blocking accept() so the loop sees _running is False
+                socket.create_connection((self.host, self.port), timeout = 1).close()
+            except OSError:
+                pass
+
+class DSUCluster:
+    '''A DSU server of several worker processes, so it is not held to one core. Every worker is a complete DSUServer accepting on the same
+    port (with SO_REUSEPORT where the platform has it, otherwise on one listening socket they share). The workers share the store, which
+    must be safe across processes, and the parent relays new message and session events between them over a ds_bus BusHub.
+    Started and stopped like a DSUServer: start_server blocks until shutdown is called'''
+    def __init__(self, host = '127.0.0.1', port = 3001, processes = PROCESSES, store_dir = STORE_DIR_PATH, backend = 'sqlite',
+                 use_async = False, profile = False, **options):
+        if not BACKENDS[backend].process_safe:
+            raise ValueError(f'The {backend} backend cannot be shared by several processes, use sqlite')
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.store_dir = store_dir
+        self.backend = backend
+        self.use_async = use_async
+        self.profile = profile
+        self.options = options ##further DSUServer arguments for every worker
+        self.workers = [] ##the worker processes
+        self.ready = threading.Event() ##set once every worker is listening (self.port then holds the real port)
+        self._stopping = threading.Event()
+
+    def start_server(self):
+        '''Start the bus and the worker processes, then wait until shutdown is called or every worker has exited'''
+        store = BACKENDS[self.backend](self.store_dir) ##create the store once, before the workers race to
+        store.open()
+        store.close()
+        hub = BusHub(str(Path(self.store_dir) / BUS_FILE))
+        hub.start()
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if reuse_port: ##only reserves the port, the workers bind and listen on it themselves
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listener.bind((self.host, self.port))
+            self.port = listener.getsockname()[1]
+            if not reuse_port:
+                listener.listen(self.options.get('backlog') or (ASYNC_BACKLOG if self.use_async else LISTEN_BACKLOG))
+            context = multiprocessing.get_context('spawn') ##the bus threads are already running, so no fork
+            started = context.Queue()
+            for _ in range(self.processes):
+                worker = context.Process(target = _run_worker, daemon = True,
+                                         args = (started, self.host, self.port, None if reuse_port else listener, self.store_dir,
+                                                 self.backend, self.use_async, self.profile, DEBUG, self.options))
+                worker.start()
+                self.workers.append(worker)
+            for _ in self.workers:
+                try:
+                    started.get(timeout = 30)
+                except queue.Empty:
+                    raise RuntimeError('A worker process did not start') from None
+            if DEBUG:
+                print(f'DSUserver is listening on port {self.port} with {self.processes} worker processes')
+            self.ready.set()
+            while not self._stopping.wait(0.5) and any(worker.is_alive() for worker in self.workers):
+                pass
+        except KeyboardInterrupt as e:
+            if DEBUG:
+                print(f'Server shutting down...')
+        finally:
+            for worker in self.workers:
+                worker.terminate() ##committed data is safe in the store, there is nothing else to flush
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+            hub.close()
+            listener.close()
+            self.ready.clear()
+            self._stopping.clear()
+
+    def shutdown(self):
+        '''Stop a running cluster from another thread. start_server returns once every worker has exited'''
+        self._stopping.set()
+
+def _run_worker(started, host, port, listen_socket, store_dir, backend, use_async, profile, debug, options):
+    '''Body of a DSUCluster worker process: a DSUServer on the shared port that has joined the bus. Reports its pid on started once listening'''
+    global DEBUG
+    DEBUG = debug
+    server = DSUServer(host, port, store_dir, backend = backend, profile = profile, reuse_port = listen_socket is None,
+                       listen_socket = listen_socket, bus_path = str(Path(store_dir) / BUS_FILE), **options)
+    def report_started():
+        server.ready.wait()
+        started.put(os.getpid())
+    threading.Thread(target = report_started, daemon = True).start()
+    if use_async:
+        server.start_async_server()
+    else:
         server.start_server()
+
+def run_server(host = '127.0.0.1', port1 = 3001, use_async = False, backend = 'json', profile = False, processes = 1,
+               retention_days = None, snapshot = False):
+    try:
+        if processes > 1:
+            server = DSUCluster(host, port1, processes, backend = backend, use_async = use_async, profile = profile)
+            server.start_server()
+        else:
+            server = DSUServer(host, port1, backend = backend, profile = profile, retention_days = retention_days, snapshot = snapshot)
+            if use_async:
+                server.start_async_server()
+            else:
+                server.start_server()
     except Exception as e:
         print(f'Server raised the following error:{e}')
     
 if __name__ == '__main__':
+    ##usage: python server.py [port] [--async] [--sqlite | --memory [--snapshot]] [--debug] [--profile] [--processes=N] [--retention=DAYS]
+    ##--memory keeps the store in memory only, --snapshot loads store/users.json on start and writes it back on exit
+    ##--processes=N runs N worker processes (N defaults to the number of cores), which needs --sqlite
+    ##--retention=DAYS moves read messages older than DAYS days to the cold archive (json backend only)
     host = '127.0.0.1'
     port1 = 3001
     port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) >= 1:
+        port1 = int(args[0])
+   
+    processes = 1
+    retention_days = None
+    for arg in sys.argv[1:]:
+        if arg == '--processes':
+            processes = PROCESSES
+        elif arg.startswith('--processes='):
+            processes = int(arg.split('=', 1)[1])
+        elif arg.startswith('--retention='):
+            retention_days = float(arg.split('=', 1)[1])
    
-    run_server(host,port1)
+    DEBUG = '--debug' in sys.argv
+    backend = 'sqlite' if '--sqlite' in sys.argv else 'memory' if '--memory' in sys.argv else 'json'
+    run_server(host,port1, use_async = '--async' in sys.argv, backend = backend, profile = '--profile' in sys.argv,
+               processes = processes, retention_days = retention_days, snapshot = '--snapshot' in sys.argv)
 
 
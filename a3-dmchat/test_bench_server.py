@@ -0,0 +1,62 @@
+import json
+import pytest # type: ignore
+from bench_server import codec_report, compression_report, main, parse_mix, percentiles
+
+def test_parse_mix():
+    assert parse_mix("send=3,all=1") == {"send": 3, "all": 1}
+    with pytest.raises(ValueError):
+        parse_mix("delete=1")
+
+def test_percentiles():
+    stats = percentiles([0.001 * i for i in range(1, 101)])
+    assert stats["count"] == 100
+    assert stats["p50_ms"] == pytest.approx(51)
+    assert stats["p99_ms"] == pytest.approx(100)
+
+@pytest.mark.parametrize("engine", [[], ["--async"]])
+def test_small_benchmark_run(tmp_path, engine):
+    out = tmp_path / "results.json"
+    main(["--clients", "2", "--ops", "5", "--users", "3", "--sizes", "0,10",
+          "--output", str(out)] + engine)
+    report = json.loads(out.read_text())
+    assert [r["store_messages"] for r in report["results"]] == [0, 10]
+    for result in report["results"]:
+        assert result["errors"] == 0
+        assert result["operations"] == 2 * 6   # initial auth + 5 ops each
+        assert result["throughput_ops_s"] > 0
+
+def test_compression_report():
+    row = compression_report(200, repeat=1)
+    assert row["messages"] == 200
+    assert row["compressed_bytes"] < row["plain_bytes"]
+    assert 0 < row["saved_pct"] < 100
+
+def test_compressed_clients_run():
+    report = main(["--clients", "2", "--ops", "5", "--users", "3", "--sizes", "50",
+                   "--compress", "--compression", "10"])
+    assert report["config"]["compress"] is True
+    assert report["results"][0]["errors"] == 0
+    assert report["compression"][0]["messages"] == 10
+
+def test_codec_report():
+    report = codec_report(50, history=5)
+    for name in ("json", "binary"):
+        assert report[name]["encode_dm_per_s"] > 0
+        assert report[name]["decode_fetch_per_s"] > 0
+    assert report["binary"]["fetch_bytes"] < report["json"]["fetch_bytes"]
+
+def test_binary_clients_run():
+    report = main(["--clients", "2", "--ops", "5", "--users", "3", "--sizes", "50", "--binary"])
+    assert report["config"]["encoding"] == "binary"
+    assert report["results"][0]["errors"] == 0
+
+def test_multi_process_run():
+    report = main(["--clients", "2", "--ops", "5", "--users", "3", "--sizes", "10",
+                   "--backend", "sqlite", "--processes", "2"])
+    assert report["config"]["processes"] == 2
+    assert report["results"][0]["errors"] == 0
+
+def test_memory_backend_run():
+    report = main(["--clients", "2", "--ops", "5", "--users", "3", "--sizes", "20",
+                   "--backend", "memory", "--mix", "unread=1,all=1"])
+    assert report["results"][0]["errors"] == 0
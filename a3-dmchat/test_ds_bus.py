@@ -0,0 +1,52 @@
+import json
+import socket
+import threading
+import pytest # type: ignore
+from ds_bus import BusHub, BusClient
+
+@pytest.fixture
+def hub(tmp_path):
+    h = BusHub(str(tmp_path / "bus.sock"))
+    h.start()
+    yield h
+    h.close()
+
+def _client(hub):
+    events = []
+    arrived = threading.Event()
+    def on_event(event):
+        events.append(event)
+        arrived.set()
+    client = BusClient(hub.path, on_event)
+    client.connect()
+    return client, events, arrived
+
+def test_events_reach_every_other_client(hub):
+    a, a_events, _ = _client(hub)
+    b, b_events, b_arrived = _client(hub)
+    c, c_events, c_arrived = _client(hub)
+    a.publish({"op": "new", "user": "bob", "text": "two\nlines"})
+    assert b_arrived.wait(5) and c_arrived.wait(5)
+    assert b_events == c_events == [{"op": "new", "user": "bob", "text": "two\nlines"}]
+    assert a_events == []  # never echoed back to the publisher
+    for client in (a, b, c):
+        client.close()
+
+def test_partial_lines_are_held_back(hub):
+    b, b_events, b_arrived = _client(hub)
+    raw = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    raw.connect(hub.path)
+    line = json.dumps({"op": "release", "token": "t"}).encode() + b"\n"
+    raw.sendall(line[:5])
+    raw.sendall(line[5:])
+    assert b_arrived.wait(5)
+    assert b_events == [{"op": "release", "token": "t"}]
+    raw.close()
+    b.close()
+
+def test_publish_without_hub_is_dropped(hub):
+    a, _, _ = _client(hub)
+    hub.close()
+    a.publish({"op": "new", "user": "bob"})  # does not raise
+    a.close()
+    a.publish({"op": "new", "user": "bob"})
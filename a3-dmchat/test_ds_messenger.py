@@ -1,8 +1,10 @@
 import json
 import socket
-from io import StringIO
+import time
+from io import BytesIO, StringIO
 import pytest # type: ignore
 from ds_messenger import DirectMessenger, DirectMessage
+from ds_protocol import compress_frame, pack_response, unpack_request
 
 class DummySocket:
     def __init__(self, responses):
@@ -111,4 +113,187 @@ def test_init_authentication_fails(fake_socket):
     # Expect to raise ValueError
     with pytest.raises(ValueError) as exc:
         DirectMessenger("host:1", "alice", "wrongpw")
-    assert "Authentication failed" in str(exc.value)
\ No newline at end of file
+    assert "Authentication failed" in str(exc.value)
+
+def test_retrieve_since(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    since = json.dumps({"response":{"type":"ok","messages":[
+        {"from":"alice","message":"later","timestamp":"12.5"}
+    ]}})
+    sock = fake_socket([auth, since])
+    dm = DirectMessenger("h:1","bob","p")
+    msgs = dm.retrieve_since(10.0)
+    assert [m.message for m in msgs] == ["later"]
+    assert msgs[0].timestamp == 12.5
+    req = json.loads(sock.writer.getvalue().splitlines()[1])
+    assert req == {"token": "X", "fetch": {"since": "10.0"}}
+
+def test_push_frames_are_set_aside(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    push = json.dumps({"response":{"type":"push","messages":[
+        {"from":"alice","message":"pushed","timestamp":"5"}
+    ]}})
+    send_ok = json.dumps({"response":{"type":"ok","message":"Sent"}})
+    fake_socket([auth, push, send_ok])
+    dm = DirectMessenger("h:1","bob","p")
+    # the push arrives before the send() reply and must not be taken for it
+    assert dm.send("hey", "alice") is True
+    pushed = dm.retrieve_pushed()
+    assert [m.message for m in pushed] == ["pushed"]
+    assert pushed[0].sender == "alice"
+    assert dm.retrieve_pushed() == []
+
+def test_subscribe_starts_reader(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    sub = json.dumps({"response":{"type":"ok","message":"Subscribed"}})
+    push = json.dumps({"response":{"type":"push","messages":[
+        {"from":"alice","message":"hi","timestamp":"5"}
+    ]}})
+    send_ok = json.dumps({"response":{"type":"ok","message":"Sent"}})
+    sock = fake_socket([auth, sub, push, send_ok])
+    dm = DirectMessenger("h:1","bob","p")
+    assert dm.subscribe() is True
+    assert dm.send("yo", "alice") is True
+    assert [m.message for m in dm.retrieve_pushed()] == ["hi"]
+    req = json.loads(sock.writer.getvalue().splitlines()[1])
+    assert req == {"token": "X", "subscribe": True}
+
+def test_reconnect_resumes_session(monkeypatch):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    resumed = json.dumps({"response":{"type":"ok","message":"Welcome back","token":"X"}})
+    expired = json.dumps({"response":{"type":"error","message":"Invalid or expired session token."}})
+    new_auth = json.dumps({"response":{"type":"ok","message":"OK","token":"Y"}})
+    sockets = [DummySocket([auth]), DummySocket([resumed]), DummySocket([expired, new_auth])]
+    for s in sockets:
+        s.close = lambda: None
+    monkeypatch.setattr(socket, "create_connection", lambda addr: sockets.pop(0))
+    dm = DirectMessenger("h:1","bob","p")
+    assert dm.reconnect() is True
+    assert dm.token == "X"
+    assert dm.reconnect() is False
+    assert dm.token == "Y"
+
+def test_iter_messages_streams_chunks(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    chunk = lambda *texts: json.dumps({"response":{"type":"chunk","messages":[
+        {"from":"alice","message":t,"timestamp":"1"} for t in texts]}})
+    end = json.dumps({"response":{"type":"end","message":"3 messages sent."}})
+    send_ok = json.dumps({"response":{"type":"ok","message":"Sent"}})
+    sock = fake_socket([auth, chunk("a", "b"), chunk("c"), end,
+                        chunk("x"), chunk("y"), end, send_ok])
+    dm = DirectMessenger("h:1","bob","p")
+    assert [m.message for m in dm.iter_messages(after=0)] == ["a", "b", "c"]
+    req = json.loads(sock.writer.getvalue().splitlines()[1])
+    assert req == {"token": "X", "fetch": {"after": "0", "stream": True}}
+    # stopping early still consumes the rest of the stream
+    for m in dm.iter_messages():
+        break
+    assert dm.send("hi", "alice") is True
+
+def test_compression_negotiated(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X","compress":"zlib"}})
+    many = json.dumps({"response":{"type":"ok","messages":[
+        {"from":"alice","message":"m%d" % i,"timestamp":str(i)} for i in range(200)]}})
+    sock = fake_socket([auth, compress_frame(many.encode()).decode()])
+    dm = DirectMessenger("h:1","bob","p", compress=True)
+    assert json.loads(sock.writer.getvalue().splitlines()[0])["authenticate"]["compress"] == "zlib"
+    msgs = dm.retrieve_all()
+    assert len(msgs) == 200 and msgs[-1].message == "m199"
+
+class BinaryDummySocket(DummySocket):
+    def __init__(self, auth, frames):
+        super().__init__([auth])
+        self.breader = BytesIO(b"".join(frames))
+        self.bwriter = BytesIO()
+    def makefile(self, mode):
+        if "b" in mode:
+            return self.breader if "r" in mode else self.bwriter
+        return super().makefile(mode)
+
+def test_binary_encoding(monkeypatch):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X","encoding":"binary"}})
+    frames = [pack_response("ok", "Sent"),
+              pack_response("push", "", [{"from":"alice","message":"pushed","timestamp":"4"}]),
+              pack_response("ok", "", [{"from":"alice","message":"hi","timestamp":"5"}])]
+    sock = BinaryDummySocket(auth, frames)
+    monkeypatch.setattr(socket, "create_connection", lambda addr: sock)
+    dm = DirectMessenger("h:1","bob","p", binary=True)
+    assert json.loads(sock.writer.getvalue())["authenticate"]["encoding"] == "binary"
+    assert dm.send("yo", "alice") is True
+    msgs = dm.retrieve_new()
+    assert [(m.sender, m.message, m.timestamp) for m in msgs] == [("alice", "hi", 5.0)]
+    assert [m.message for m in dm.retrieve_pushed()] == ["pushed"]
+    sent = sock.bwriter.getvalue()
+    first = unpack_request(sent[4:4 + int.from_bytes(sent[:4], "big")])
+    assert first["directmessage"]["entry"] == "yo" and first["token"] == "X"
+
+def test_search(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    hits = json.dumps({"response":{"type":"ok","messages":[
+        {"from":"alice","message":"lunch?","timestamp":"3.0"}
+    ]}})
+    sock = fake_socket([auth, hits])
+    dm = DirectMessenger("h:1","bob","p")
+    msgs = dm.search("lunch", contact="alice")
+    assert [(m.sender, m.message) for m in msgs] == [("alice", "lunch?")]
+    req = json.loads(sock.writer.getvalue().splitlines()[1])
+    assert req == {"token": "X", "search": {"query": "lunch", "contact": "alice"}}
+
+def test_send_to_several_recipients(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    ok = json.dumps({"response":{"type":"ok","message":"Direct message sent"}})
+    sock = fake_socket([auth, ok])
+    dm = DirectMessenger("h:1","alice","p")
+    assert dm.send("hi all", ["bob", "carol"])
+    req = json.loads(sock.writer.getvalue().splitlines()[1])
+    assert req["directmessage"]["recipient"] == ["bob", "carol"]
+
+def test_send_retries_with_same_message_id(monkeypatch):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    resumed = json.dumps({"response":{"type":"ok","message":"Welcome back","token":"X"}})
+    ok = json.dumps({"response":{"type":"ok","message":"Direct message sent"}})
+    first, second = DummySocket([auth]), DummySocket([resumed, ok])
+    first.close = lambda: None
+    sockets = [first, second]
+    monkeypatch.setattr(socket, "create_connection", lambda addr: sockets.pop(0))
+    dm = DirectMessenger("h:1","alice","p")
+    # the connection drops before the server answers: resume and send again
+    assert dm.send("hi", "bob") is True
+    sent = json.loads(first.writer.getvalue().splitlines()[1])["directmessage"]
+    resent = json.loads(second.writer.getvalue().splitlines()[1])["directmessage"]
+    assert sent["message_id"] and resent == sent
+
+def test_lost_push_connection_is_reported(fake_socket):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    sub = json.dumps({"response":{"type":"ok","message":"Subscribed"}})
+    push = json.dumps({"response":{"type":"push","messages":[
+        {"from":"alice","message":"hi","timestamp":"5"}
+    ]}})
+    fake_socket([auth, sub, push])
+    dm = DirectMessenger("h:1","bob","p")
+    assert dm.subscribe() is True
+    deadline = time.monotonic() + 5
+    while not dm._lost and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # what arrived before the connection closed is still delivered
+    assert [m.message for m in dm.retrieve_pushed()] == ["hi"]
+    with pytest.raises(ConnectionError):
+        dm.retrieve_pushed()
+
+def test_retried_send_renews_subscription(monkeypatch):
+    auth = json.dumps({"response":{"type":"ok","message":"OK","token":"X"}})
+    sub = json.dumps({"response":{"type":"ok","message":"Subscribed"}})
+    resumed = json.dumps({"response":{"type":"ok","message":"Welcome back","token":"X"}})
+    ok = json.dumps({"response":{"type":"ok","message":"Direct message sent"}})
+    # the first connection closes before the send is answered
+    first, second = DummySocket([auth, sub]), DummySocket([resumed, sub, ok])
+    first.close = lambda: None
+    sockets = [first, second]
+    monkeypatch.setattr(socket, "create_connection", lambda addr: sockets.pop(0))
+    dm = DirectMessenger("h:1","alice","p")
+    assert dm.subscribe() is True
+    assert dm.send("hi", "bob") is True
+    assert dm.subscribed
+    requests = [json.loads(line) for line in second.writer.getvalue().splitlines()]
+    assert requests[1] == {"token": "X", "subscribe": True}
+    assert "directmessage" in requests[2]
@@ -0,0 +1,31 @@
+import pytest # type: ignore
+from ds_metrics import LatencyHistogram, ServerMetrics
+
+def test_histogram_percentiles():
+    h = LatencyHistogram()
+    for _ in range(98):
+        h.record(0.001)      # 1 ms
+    h.record(0.100)
+    h.record(0.200)
+    snap = h.snapshot()
+    assert snap["count"] == 100
+    assert 1.0 <= snap["p50_ms"] <= 2.1
+    assert snap["p99_ms"] >= 100
+    assert snap["max_ms"] == pytest.approx(200)
+
+def test_empty_histogram():
+    assert LatencyHistogram().snapshot()["p95_ms"] == 0.0
+
+def test_server_metrics_snapshot_and_reset():
+    m = ServerMetrics(enabled=True)
+    m.record_command("fetch", 0.002)
+    m.record_lock(0.0001, 0.0005)
+    m.add_bytes(inbound=10, outbound=20)
+    m.connection_opened()
+    snap = m.snapshot()
+    assert snap["commands"]["fetch"]["count"] == 1
+    assert snap["lock_hold"]["count"] == 1
+    assert (snap["bytes_in"], snap["bytes_out"], snap["connections"]) == (10, 20, 1)
+    m.reset()
+    assert m.snapshot()["commands"] == {}
+    assert m.snapshot()["connections"] == 1
@@ -4,6 +4,23 @@ from ds_protocol import (
     build_authenticate,
     build_directmessage,
     build_fetch,
+    build_fetch_since,
+    build_fetch_page,
+    build_search,
+    build_subscribe,
+    build_resume,
+    compress_frame,
+    pack_directmessage,
+    pack_groupmessage,
+    pack_fetch,
+    pack_fetch_since,
+    pack_fetch_page,
+    pack_search,
+    pack_subscribe,
+    pack_response,
+    unpack_request,
+    unpack_response,
+    decompress_frame,
     parse_response,
     DSPResponse
 )
@@ -32,6 +49,80 @@ def test_build_fetch(what):
     obj = json.loads(s)
     assert obj == {"token": "tokenXYZ", "fetch": what}
 
+def test_build_fetch_since():
+    s = build_fetch_since("tok", 1625078400.5)
+    obj = json.loads(s)
+    assert obj == {"token": "tok", "fetch": {"since": "1625078400.5"}}
+
+def test_build_fetch_page():
+    assert json.loads(build_fetch_page("tok", after=1.5, limit=10)) == \
+        {"token": "tok", "fetch": {"after": "1.5", "limit": 10}}
+    assert json.loads(build_fetch_page("tok", before=2, stream=True))["fetch"] == \
+        {"before": "2", "stream": True}
+
+def test_build_subscribe():
+    assert json.loads(build_subscribe("tok")) == {"token": "tok", "subscribe": True}
+    assert json.loads(build_subscribe("tok", False))["subscribe"] is False
+
+def test_build_resume():
+    assert json.loads(build_resume("tok")) == {"resume": {"token": "tok"}}
+
+def test_build_authenticate_compress():
+    obj = json.loads(build_authenticate("alice", "pw", compress=True))
+    assert obj["authenticate"]["compress"] == "zlib"
+    assert "compress" not in json.loads(build_authenticate("alice", "pw"))["authenticate"]
+
+def test_compressed_frame_round_trip():
+    small = b'{"response": {"type": "ok"}}'
+    assert compress_frame(small) == small
+    big = json.dumps({"response": {"type": "ok", "messages": [
+        {"from": "alice", "message": "hello", "timestamp": str(i)} for i in range(100)]}}).encode()
+    packed = compress_frame(big)
+    assert len(packed) < len(big) // 4
+    assert b"\r" not in packed and b"\n" not in packed
+    assert decompress_frame(packed.decode()) == big.decode()
+    assert decompress_frame(small.decode()) == small.decode()
+    with pytest.raises(ValueError):
+        decompress_frame(packed.decode(), max_size=100)
+    with pytest.raises(ValueError):
+        decompress_frame('{"z": "not base64!"}')
+
+def test_binary_requests_decode_like_json():
+    cases = [
+        (pack_directmessage("tok", "h\u00e9llo", "bob", 1.5), build_directmessage("tok", "h\u00e9llo", "bob", 1.5)),
+        (pack_fetch("tok", "all"), build_fetch("tok", "all")),
+        (pack_fetch("tok", "unread"), build_fetch("tok", "unread")),
+        (pack_subscribe("tok", False), build_subscribe("tok", False)),
+        (pack_groupmessage("tok", "hi", ["bob", "c\u00e9"], 2.5), build_directmessage("tok", "hi", ["bob", "c\u00e9"], 2.5)),
+        (pack_directmessage("tok", "hi", "bob", 1.5, "m1"), build_directmessage("tok", "hi", "bob", 1.5, "m1")),
+        (pack_groupmessage("tok", "hi", ["bob"], 2.5, "m2"), build_directmessage("tok", "hi", ["bob"], 2.5, "m2")),
+    ]
+    for frame, text in cases:
+        assert unpack_request(frame[4:]) == json.loads(text)
+    assert unpack_request(pack_fetch_since("tok", 2.5)[4:]) == {"token": "tok", "fetch": {"since": 2.5}}
+    page = unpack_request(pack_fetch_page("tok", before=9.0, limit=3, stream=True)[4:])
+    assert page == {"token": "tok", "fetch": {"before": 9.0, "limit": 3, "stream": True}}
+
+def test_binary_request_errors():
+    frame = pack_fetch("tok", "all")[4:]
+    for bad in [b"", b"\x63" + frame[1:], frame[:-1], frame + b"x"]:
+        with pytest.raises(ValueError):
+            unpack_request(bad)
+
+def test_binary_response_round_trip():
+    messages = [{"from": "alice", "message": "hi \U0001f600", "timestamp": "1.5"},
+                {"recipient": "bob", "message": "", "timestamp": "2"}]
+    frame = pack_response("chunk", "", messages)
+    assert int.from_bytes(frame[:4], "big") == len(frame) - 4
+    resp = unpack_response(frame[4:])
+    assert resp.type == "chunk"
+    assert resp.messages == [{"from": "alice", "message": "hi \U0001f600", "timestamp": 1.5},
+                             {"recipient": "bob", "message": "", "timestamp": 2.0}]
+    err = unpack_response(pack_response("error", "Invalid user token.")[4:])
+    assert (err.type, err.message, err.messages) == ("error", "Invalid user token.", [])
+    with pytest.raises(ValueError):
+        unpack_response(frame[4:-3])
+
 def test_parse_response_full():
     payload = {
         "response": {
@@ -64,4 +155,12 @@ def test_parse_response_missing_response():
 def test_parse_response_invalid_json():
     with pytest.raises(ValueError) as exc:
         parse_response("}{ not valid json")
-    assert "Invalid JSON" in str(exc.value)
\ No newline at end of file
+    assert "Invalid JSON" in str(exc.value)
+
+def test_build_search():
+    assert json.loads(build_search("tok", "lunch")) == {"token": "tok", "search": {"query": "lunch"}}
+    assert json.loads(build_search("tok", "lunch", contact="bob", after=1, limit=5))["search"] == \
+        {"query": "lunch", "contact": "bob", "after": "1", "limit": 5}
+    assert unpack_request(pack_search("tok", "lunch", "bob", before=2.5, limit=5)[4:]) == \
+        {"token": "tok", "search": {"query": "lunch", "contact": "bob", "before": 2.5, "limit": 5}}
+    assert unpack_request(pack_search("tok", "lunch")[4:]) == json.loads(build_search("tok", "lunch"))
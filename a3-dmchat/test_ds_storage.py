@@ -0,0 +1,645 @@
+import json
+import sqlite3
+import threading
+import time
+import pytest # type: ignore
+import ds_storage
+from ds_storage import LogStore, SQLiteStore, BACKENDS, migrate_to_sqlite
+from ds_storage import WireMessage, encode_messages_response
+
+PERSISTENT = ["json", "sqlite"]  # backends that keep their data across a reopen
+
+@pytest.fixture
+def store(tmp_path):
+    s = LogStore(str(tmp_path / "store"))
+    s.open()
+    yield s
+    s.close()
+
+def test_create_and_get_user(store):
+    assert store.get_user("alice") is None
+    assert store.create_user("alice", "pw") is True
+    assert store.create_user("alice", "other") is False
+    assert store.get_user("alice")["password"] == "pw"
+
+def test_send_requires_both_users(store):
+    store.create_user("alice", "pw")
+    assert store.add_message("hi", "alice", "bob", "1.0") is False
+    store.create_user("bob", "pw")
+    assert store.add_message("hi", "alice", "bob", "1.0") is True
+
+def test_read_unread_then_all(store):
+    store.create_user("alice", "pw")
+    store.create_user("bob", "pw")
+    store.add_message("second", "alice", "bob", "2.0")
+    store.add_message("first", "alice", "bob", "1.0")
+    unread = store.read_unread("bob")
+    assert [m["message"] for m in unread] == ["first", "second"]
+    assert store.read_unread("bob") == []
+    assert store.read_all("alice") == [
+        {"recipient": "bob", "message": "first", "timestamp": "1.0"},
+        {"recipient": "bob", "message": "second", "timestamp": "2.0"},
+    ]
+    assert store.read_all("carol") is False
+
+def test_send_is_one_log_append(store):
+    store.create_user("alice", "pw")
+    store.create_user("bob", "pw")
+    snapshot = store.users_path.read_text()
+    store.add_message("hi", "alice", "bob", "1.0")
+    assert store.users_path.read_text() == snapshot
+    last = store.log_path.read_text().splitlines()[-1]
+    assert json.loads(last)["op"] == "dm"
+
+def test_replay_matches_snapshot(tmp_path):
+    s1 = LogStore(str(tmp_path))
+    s1.open()
+    s1.create_user("alice", "pw")
+    s1.create_user("bob", "pw")
+    s1.add_message("hi", "alice", "bob", "1.0")
+    s1.read_unread("bob")
+    s1.add_message("yo", "bob", "alice", "2.0")
+    # simulate a crash: log is never compacted
+    s2 = LogStore(str(tmp_path))
+    s2.open()
+    assert s2._users == s1._users
+    s2.close()
+    snapshot = json.loads((tmp_path / "users.json").read_text())
+    assert snapshot == s1._users
+    assert snapshot["bob"]["messages"][0]["status"] == "read"
+    assert snapshot["alice"]["messages"][1]["status"] == "unread"
+
+def test_compaction_truncates_log(tmp_path):
+    s = LogStore(str(tmp_path), compact_every=3)
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("hi", "alice", "bob", "1.0")
+    assert s.log_path.read_text() == ""
+    assert "alice" in json.loads(s.users_path.read_text())
+    s.close()
+
+def test_torn_log_tail_is_ignored(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s._log.write('{"op": "user", "userna')
+    s._log.flush()
+    s2 = LogStore(str(tmp_path))
+    s2.open()
+    assert list(s2._users) == ["alice"]
+    # the torn fragment is cut off, so records written after it replay
+    s2.create_user("bob", "pw")
+    s2.add_message("hi", "alice", "bob", "1.0")
+    s3 = LogStore(str(tmp_path))
+    s3.open()
+    assert [m["message"] for m in s3.read_all("bob")] == ["hi"]
+
+def test_non_string_message_is_rejected(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    with pytest.raises(TypeError):
+        s.add_message(123, "alice", "bob", "1.0")
+    with pytest.raises(TypeError):
+        s.add_group_message(None, "alice", ["bob"], "1.0")
+    assert s.read_all("alice") == []
+    s.close()
+    s = LogStore(str(tmp_path))
+    s.open()  # nothing half written reached the snapshot
+    assert s.read_all("bob") == []
+    s.close()
+
+def test_unrelated_users_do_not_share_a_lock(tmp_path):
+    s = LogStore(str(tmp_path), shard_count=8)
+    s.open()
+    names = ["user%d" % i for i in range(40)]
+    for n in names:
+        s.create_user(n, "pw")
+    a = names[0]
+    b = next(n for n in names if s._shard(n) != s._shard(a))
+    with s._locked(a):
+        # b's shard is free while a's is held
+        assert s.read_unread(b) == []
+    s.close()
+
+def test_concurrent_sends_are_all_stored(tmp_path):
+    s = LogStore(str(tmp_path), compact_every=50)
+    s.open()
+    names = ["u%d" % i for i in range(6)]
+    for n in names:
+        s.create_user(n, "pw")
+    def worker(i):
+        for j in range(100):
+            s.add_message("m", names[i], names[(i + j) % 6], str(j))
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = sum(len(s.read_all(n)) for n in names)
+    assert total == 2 * 6 * 100
+    s.close()
+    s2 = LogStore(str(tmp_path))
+    s2.open()
+    assert sum(len(s2.read_all(n)) for n in names) == total
+
+def test_read_since_is_exclusive_and_ordered(store):
+    store.create_user("alice", "pw")
+    store.create_user("bob", "pw")
+    store.add_message("b", "alice", "bob", "2.0")
+    store.add_message("a", "alice", "bob", "1.0")
+    store.add_message("c", "bob", "alice", "3.0")
+    assert [m["message"] for m in store.read_since("bob", 1.0)] == ["b", "c"]
+    assert store.read_since("bob", 3.0) == []
+    assert store.read_since("carol", 0) is False
+    # read-only: the messages are still unread
+    assert len(store.read_unread("bob")) == 2
+
+def test_assigned_timestamps_strictly_increase(store):
+    store.create_user("alice", "pw")
+    store.create_user("bob", "pw")
+    for _ in range(50):
+        store.add_message("x", "alice", "bob")
+    stamps = [float(m["timestamp"]) for m in store.read_all("bob")]
+    assert all(a < b for a, b in zip(stamps, stamps[1:]))
+    assert store.read_since("bob", stamps[24]) == store.read_all("bob")[25:]
+
+def test_unread_queue_only_holds_unread(store):
+    store.create_user("alice", "pw")
+    store.create_user("bob", "pw")
+    for i in range(5):
+        store.add_message(str(i), "alice", "bob")
+    store.read_unread("bob")
+    store.add_message("new", "alice", "bob")
+    assert [m["message"] for m in store._unread["bob"]] == ["new"]
+    log_size = store.log_path.stat().st_size
+    assert [m["message"] for m in store.read_unread("bob")] == ["new"]
+    assert store.log_path.stat().st_size - log_size < 64
+    assert store._unread["bob"] == []
+    assert all(m["status"] == "read" for m in store.get_user("bob")["messages"])
+
+def test_unread_rebuilt_from_snapshot(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("old", "alice", "bob", "1.0")
+    s.read_unread("bob")
+    s.add_message("new", "alice", "bob", "2.0")
+    s.close()
+    s2 = LogStore(str(tmp_path))
+    s2.open()
+    assert [m["message"] for m in s2.read_unread("bob")] == ["new"]
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def any_store(request, tmp_path):
+    s = BACKENDS[request.param](str(tmp_path / "store"))
+    s.open()
+    yield s
+    s.close()
+
+def test_backends_behave_alike(any_store):
+    s = any_store
+    assert s.create_user("alice", "pw") is True
+    assert s.create_user("alice", "pw") is False
+    assert s.get_user("alice")["password"] == "pw"
+    assert s.get_user("bob") is None
+    assert s.add_message("hi", "alice", "bob") is False
+    s.create_user("bob", "pw")
+    s.add_message("second", "alice", "bob", "2.0")
+    s.add_message("first", "alice", "bob", "1.0")
+    s.add_message("third", "bob", "alice")
+    assert s.read_since("bob", 1.0)[0] == {"from": "alice", "message": "second", "timestamp": "2.0"}
+    assert [m["message"] for m in s.read_unread("bob")] == ["first", "second"]
+    assert s.read_unread("bob") == []
+    assert [m["message"] for m in s.read_unread("alice")] == ["third"]
+    assert s.read_all("bob")[2]["recipient"] == "alice"
+    assert s.read_all("carol") is False
+
+@pytest.mark.parametrize("backend", PERSISTENT)
+def test_mark_read_only_given_messages(tmp_path, backend):
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    for user in ("alice", "bob", "carol"):
+        s.create_user(user, "pw")
+    s.add_message("from alice", "alice", "bob", "1.0")
+    s.add_message("from carol", "carol", "bob", "2.0")
+    unread = s.read_unread("bob", mark=False)
+    assert [m["message"] for m in unread] == ["from alice", "from carol"]
+    assert s.read_unread("bob", mark=False) == unread  # peeking leaves them unread
+    assert s.mark_read("bob", unread[:1]) is True
+    assert s.mark_read("bob", unread[:1]) is True  # already read: nothing to do
+    assert s.mark_read("dave", unread) is False
+    s.close()
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    assert [m["message"] for m in s.read_unread("bob")] == ["from carol"]
+    s.close()
+
+def test_sqlite_uses_wal_and_indexes(tmp_path):
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    db = s._db()
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    indexes = {row[1] for row in db.execute("PRAGMA index_list(messages)")}
+    assert {"messages_conversation", "messages_user_ts"} <= indexes
+    s.close()
+
+def test_migrate_json_store_to_sqlite(tmp_path):
+    src = LogStore(str(tmp_path))
+    src.open()
+    src.create_user("alice", "pw")
+    src.create_user("bob", "pw2")
+    src.add_message("read", "alice", "bob", "1.0")
+    src.read_unread("bob")
+    src.add_message("unread", "alice", "bob", "2.0")
+    expected_all = src.read_all("alice")
+    src.close()
+    assert migrate_to_sqlite(str(tmp_path)) == 2
+    db = SQLiteStore(str(tmp_path))
+    db.open()
+    assert db.get_user("bob")["password"] == "pw2"
+    assert db.read_all("alice") == expected_all
+    assert [m["message"] for m in db.read_unread("bob")] == ["unread"]
+    db.close()
+    with pytest.raises(FileExistsError):
+        migrate_to_sqlite(str(tmp_path))
+
+def test_group_commit_shares_fsyncs(tmp_path, monkeypatch):
+    fsyncs = []
+    real_fsync = ds_storage.os.fsync
+    monkeypatch.setattr(ds_storage.os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+    s = LogStore(str(tmp_path), commit_window=0.05, commit_batch=1000)
+    s.open()
+    for n in ("alice", "bob"):
+        s.create_user(n, "pw")
+    fsyncs.clear()
+    threads = [threading.Thread(target=s.add_message, args=("hi", "alice", "bob"))
+               for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(s.read_since("bob", 0)) == 20
+    assert len(fsyncs) < 20
+    # every acknowledged send is already in the log
+    lines = s.log_path.read_text().splitlines()
+    assert sum(json.loads(l)["op"] == "dm" for l in lines) == 20
+    s.close()
+
+def test_group_commit_full_batch_ends_window(tmp_path):
+    s = LogStore(str(tmp_path), commit_window=10, commit_batch=1)
+    s.open()
+    start = time.monotonic()
+    s.create_user("alice", "pw")
+    assert time.monotonic() - start < 1
+    s.close()
+
+def test_get_password(any_store):
+    assert any_store.get_password("alice") is None
+    any_store.create_user("alice", "pw")
+    assert any_store.get_password("alice") == "pw"
+
+def test_sqlite_user_directory(tmp_path):
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.close()
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    assert s._passwords == {"alice": "pw"}   # loaded at startup
+    # a user created by another process is found on a miss
+    other = SQLiteStore(str(tmp_path))
+    other.open()
+    other.create_user("bob", "pw2")
+    other.close()
+    assert s.get_password("bob") == "pw2"
+    assert s.create_user("bob", "x") is False
+    s.close()
+
+def test_cached_encoding_matches_json_dumps(any_store):
+    s = any_store
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    for text in ['plain', 'quote " and \\ slash', 'caf\u00e9 \U0001f600', '']:
+        s.add_message(text, "alice", "bob")
+    s.add_message("early", "alice", "bob", "1.0")
+    for status, messages in [("ok", s.read_since("bob", 0)), ("push", s.read_unread("bob")),
+                             ("ok", s.read_all("alice")), ("ok", s.read_unread("bob"))]:
+        expected = json.dumps({"response": {"type": status, "messages": messages}}).encode()
+        assert encode_messages_response(status, messages) == expected
+
+def test_logstore_serves_cached_messages(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("hi", "alice", "bob")
+    first = s.read_all("bob")
+    assert isinstance(first[0], WireMessage)
+    assert s.read_all("bob")[0] is first[0]  # nothing re-encoded per fetch
+    s.close()
+    s = LogStore(str(tmp_path))
+    s.open()
+    reloaded = s.read_since("bob", 0)
+    assert reloaded[0].wire == json.dumps({"from": "alice", "message": "hi",
+                                         "timestamp": first[0]["timestamp"]}).encode()
+
+def test_read_page(any_store):
+    s = any_store
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    for i in range(1, 11):
+        s.add_message(str(i), "alice", "bob", str(float(i)))
+    texts = lambda page: [m["message"] for m in page]
+    assert texts(s.read_page("bob", limit=3)) == ["1", "2", "3"]
+    assert texts(s.read_page("bob", after=3.0, limit=3)) == ["4", "5", "6"]
+    assert texts(s.read_page("bob", before=8.0, limit=3)) == ["5", "6", "7"]
+    assert texts(s.read_page("bob", after=2.0, before=5.0)) == ["3", "4"]
+    assert texts(s.read_page("bob", after=2.0, before=9.0, limit=2)) == ["3", "4"]
+    assert s.read_page("bob", after=10.0) == []
+    assert s.read_page("carol") is False
+    assert len(s.read_unread("bob")) == 10  # paging leaves read status alone
+
+def test_search(any_store):
+    s = any_store
+    for user in ("alice", "bob", "carol"):
+        s.create_user(user, "pw")
+    s.add_message("Lunch at noon?", "alice", "bob", "1.0")
+    s.add_message("lunch, then the movie", "bob", "alice", "2.0")
+    s.add_message("movie night: lunchbox not needed", "carol", "bob", "3.0")
+    s.add_message("LUNCH again", "carol", "bob", "4.0")
+    texts = lambda hits: [m["message"] for m in hits]
+    assert texts(s.search("bob", "lunch")) == ["Lunch at noon?", "lunch, then the movie", "LUNCH again"]
+    assert texts(s.search("bob", "Movie LUNCH")) == ["lunch, then the movie"]
+    assert s.search("bob", "lunch movie")[0] == {"recipient": "alice", "message": "lunch, then the movie",
+                                                 "timestamp": "2.0"}
+    assert texts(s.search("bob", "lunch", contact="carol")) == ["LUNCH again"]
+    assert texts(s.search("bob", "lunch", after=1.0, before=4.0)) == ["lunch, then the movie"]
+    assert texts(s.search("bob", "lunch", limit=2)) == ["lunch, then the movie", "LUNCH again"]
+    assert s.search("bob", "dinner") == [] and s.search("bob", "!?") == []
+    assert texts(s.search("carol", "lunchbox")) == ["movie night: lunchbox not needed"]
+    assert s.search("dave", "lunch") is False
+    assert len(s.read_unread("bob")) == 3  # searching leaves read status alone
+
+@pytest.mark.parametrize("backend", PERSISTENT)
+def test_search_index_rebuilt_on_open(tmp_path, backend):
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("see you tomorrow", "alice", "bob", "1.0")
+    s.close()
+    if backend == "sqlite":
+        # a database from before search existed gets its index on open
+        db = sqlite3.connect(str(tmp_path / "users.db"))
+        db.executescript("DROP TABLE messages_fts; DROP TRIGGER messages_fts_insert;"
+                         " DROP TRIGGER messages_fts_delete;")
+        db.close()
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    assert [m["message"] for m in s.search("bob", "Tomorrow")] == ["see you tomorrow"]
+    s.close()
+
+def test_search_without_fts5(tmp_path):
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    s.full_text = False  # as on an SQLite built without FTS5
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("catalog sent", "alice", "bob", "1.0")
+    s.add_message("the cat sat", "alice", "bob", "2.0")
+    assert [m["message"] for m in s.search("bob", "CAT")] == ["the cat sat"]
+    s.close()
+
+def test_fetch_with_nothing_unread_writes_nothing(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("hi", "alice", "bob", "1.0")
+    s.read_all("bob")
+    size = s.log_path.stat().st_size
+    records = s._committer.records
+    assert len(s.read_all("bob")) == 1 and s.read_unread("bob") == []
+    assert s.log_path.stat().st_size == size and s._committer.records == records
+    s.close()
+
+def test_sqlite_read_cursors(tmp_path):
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    for user in ("alice", "bob", "carol"):
+        s.create_user(user, "pw")
+    s.add_message("a1", "alice", "bob", "1.0")
+    s.add_message("c1", "carol", "bob", "2.0")
+    s.add_message("b1", "bob", "alice", "3.0")
+    db = s._db()
+    assert [m["message"] for m in s.read_unread("bob")] == ["a1", "c1"]
+    changes = db.total_changes
+    # polling with nothing unread, and fetching everything again, write nothing
+    assert s.read_unread("bob") == [] and len(s.read_all("bob")) == 3
+    assert db.total_changes == changes
+    s.add_message("a2", "alice", "bob", "4.0")
+    changes = db.total_changes
+    assert len(s.read_all("bob")) == 4
+    assert db.total_changes == changes + 1  # the one cursor that moved
+    assert dict(db.execute("SELECT peer, last_read FROM read_cursors WHERE user = 'bob'")) == \
+        {"alice": 8, "carol": 4}
+    # a message with an explicit timestamp older than what was read is still new
+    s.add_message("late", "carol", "bob", "0.5")
+    assert [m["message"] for m in s.read_unread("bob")] == ["late"]
+    assert [m["message"] for m in s.read_unread("alice")] == ["b1"]
+    s.close()
+
+def test_sqlite_read_cursors_from_status(tmp_path):
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    for i in range(1, 4):
+        s.add_message(str(i), "alice", "bob", str(float(i)))
+    s.close()
+    # a database from before read cursors: read state is in the status column
+    db = sqlite3.connect(str(tmp_path / "users.db"))
+    db.execute("DROP TABLE read_cursors")
+    db.execute("UPDATE messages SET status = 'read' WHERE direction = 'from' AND message = '1'")
+    db.commit()
+    db.close()
+    s.open()
+    assert [m["message"] for m in s.read_unread("bob")] == ["2", "3"]
+    s.close()
+
+def test_group_message(any_store):
+    s = any_store
+    for user in ("alice", "bob", "carol", "dave"):
+        s.create_user(user, "pw")
+    assert s.add_group_message("party at 8", "alice", ["bob", "carol", "bob"])
+    sent = s.read_all("alice")
+    assert sorted(m["recipient"] for m in sent) == ["bob", "carol"]
+    # one timestamp for the recipients, a distinct one per copy for the sender
+    assert len({m["timestamp"] for m in sent}) == 2
+    assert {s.read_since(user, 0)[0]["timestamp"] for user in ("bob", "carol")} == {sent[0]["timestamp"]}
+    for user in ("bob", "carol"):
+        assert [(m["from"], m["message"]) for m in s.read_unread(user)] == [("alice", "party at 8")]
+    assert s.read_unread("dave") == []
+    # all or nothing
+    assert not s.add_group_message("x", "alice", ["bob", "nobody"])
+    assert not s.add_group_message("x", "alice", [])
+    assert s.read_unread("bob") == [] and len(s.read_all("alice")) == 2
+
+def test_group_message_is_one_log_record(tmp_path):
+    s = LogStore(str(tmp_path))
+    s.open()
+    s.create_user("alice", "pw")
+    recipients = [f"user{i}" for i in range(100)]
+    for user in recipients:
+        s.create_user(user, "pw")
+    records = s._committer.records
+    assert s.add_group_message("hello all", "alice", recipients)
+    assert s._committer.records == records + 1
+    # every recipient's copy is one shared WireMessage
+    copies = {id(s.read_since(user, 0)[0]) for user in recipients}
+    assert len(copies) == 1
+    s.close()
+    s = LogStore(str(tmp_path))
+    s.open()
+    assert [m["message"] for m in s.read_unread("user42")] == ["hello all"]
+    s.close()
+
+@pytest.mark.parametrize("backend", PERSISTENT)
+def test_message_id_dedupe(tmp_path, backend, monkeypatch):
+    monkeypatch.setattr(ds_storage, "DEDUPE_WINDOW", 3)
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    for user in ("alice", "bob", "carol"):
+        s.create_user(user, "pw")
+    assert s.add_message("hi", "alice", "bob", message_id="m1")
+    assert s.add_message("hi", "alice", "bob", message_id="m1")  # a retry
+    assert s.add_group_message("all", "alice", ["bob", "carol"], message_id="m2")
+    assert s.add_group_message("all", "alice", ["bob", "carol"], message_id="m2")
+    assert s.add_message("hi", "bob", "alice", message_id="m1")  # ids are per sender
+    assert [m["message"] for m in s.read_unread("bob")] == ["hi", "all"]
+    s.close()
+    # the ids survive a restart
+    s = BACKENDS[backend](str(tmp_path))
+    s.open()
+    assert s.add_message("hi", "alice", "bob", message_id="m1")
+    assert s.read_unread("bob") == []
+    for i in range(3, 6):
+        assert s.add_message(str(i), "alice", "bob", message_id=f"m{i}")
+    # only the last DEDUPE_WINDOW ids are remembered
+    assert s.add_message("again", "alice", "bob", message_id="m1")
+    assert s.add_message("again", "alice", "bob", message_id="m5")
+    assert [m["message"] for m in s.read_unread("bob")] == ["3", "4", "5", "again"]
+    s.close()
+
+def test_retention_moves_old_read_messages_to_archive(tmp_path):
+    s = LogStore(str(tmp_path), retention_days=1)
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    for i in range(1, 6):
+        s.add_message(f"old {i}", "alice", "bob", str(float(i)))
+    s.read_all("bob")
+    s.add_message("old unread", "alice", "bob", "6.0")
+    s.add_message("recent", "alice", "bob")
+    s.compact()
+    # the hot store keeps what is recent or unread
+    hot = json.loads(s.users_path.read_text())["bob"]["messages"]
+    assert [m["message"] for m in hot] == ["old unread", "recent"]
+    # sent copies are never unread
+    assert [m["message"] for m in s.read_all("alice")] == ["recent"]
+    assert (tmp_path / "archive" / "bob.seg").exists()
+    # paged fetches reach the archive too, in timestamp order
+    everything = [f"old {i}" for i in range(1, 6)] + ["old unread", "recent"]
+    assert [m["message"] for m in s.read_page("bob")] == everything
+    assert [m["message"] for m in s.read_page("bob", after=2.0, limit=2)] == ["old 3", "old 4"]
+    assert [m["message"] for m in s.read_page("bob", before=7.0, limit=3)] == ["old 4", "old 5", "old unread"]
+    s.add_message("late", "alice", "bob", "0.5")
+    s.read_unread("bob")
+    s.compact()
+    assert [m["message"] for m in s.read_page("bob", limit=2)] == ["late", "old 1"]
+    s.close()
+    # a segment from a compaction that never wrote its snapshot is ignored
+    with (tmp_path / "archive" / "bob.seg").open("ab") as archive:
+        archive.write(b"\0" * 40)
+    s = LogStore(str(tmp_path))
+    s.open()
+    assert [m["message"] for m in s.read_page("bob")] == ["late"] + everything
+    s.close()
+    migrate_to_sqlite(str(tmp_path))
+    s = SQLiteStore(str(tmp_path))
+    s.open()
+    assert [m["message"] for m in s.read_page("bob")] == ["late"] + everything
+    assert s.read_unread("bob") == []
+    s.close()
+
+def test_memory_store(tmp_path):
+    s = ds_storage.MemoryStore(str(tmp_path / "store"))
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    assert s.add_message("hi", "alice", "bob")
+    s.compact()
+    s.close()
+    # never touches the disk
+    assert not (tmp_path / "store").exists()
+    s.open()
+    assert s.get_user("alice") is None
+
+def test_memory_store_snapshot(tmp_path):
+    s = ds_storage.MemoryStore(str(tmp_path), snapshot=True)
+    s.open()
+    s.create_user("alice", "pw")
+    s.create_user("bob", "pw")
+    s.add_message("hi", "alice", "bob", "1.0")
+    assert not (tmp_path / "users.json").exists()
+    s.close()
+    # the snapshot is a json store's, and a memory store starts from one too
+    json_store = LogStore(str(tmp_path))
+    json_store.open()
+    assert [m["message"] for m in json_store.read_all("bob")] == ["hi"]
+    json_store.add_message("reply", "bob", "alice", "2.0")
+    json_store.close()
+    s.open()
+    assert [m["message"] for m in s.read_unread("alice")] == ["reply"]
+    assert s.read_unread("bob") == []
+    s.close()
+
+def test_group_message_keeps_sender_cursors_exact(any_store):
+    s = any_store
+    recipients = [f"user{i}" for i in range(30)]
+    for user in ["alice"] + recipients:
+        s.create_user(user, "pw")
+    assert s.add_group_message("hello all", "alice", recipients)
+    # paging on the last timestamp seen walks the whole mailbox
+    seen, after = [], None
+    while True:
+        page = s.read_page("alice", after=after, limit=7)
+        if not page:
+            break
+        seen += [m["recipient"] for m in page]
+        after = float(page[-1]["timestamp"])
+    assert seen == recipients
+
+def test_messages_to_self_keep_cursors_exact(any_store):
+    s = any_store
+    for user in ("alice", "bob"):
+        s.create_user(user, "pw")
+    for i in range(3):
+        assert s.add_message(f"note {i}", "alice", "alice")
+    assert s.add_group_message("all of us", "alice", ["bob", "alice"])
+    timestamps = [m["timestamp"] for m in s.read_all("alice")]
+    assert len(set(timestamps)) == len(timestamps) == 9
+    # paging on the last timestamp seen, one at a time, misses nothing
+    seen, after = [], None
+    while True:
+        page = s.read_page("alice", after=after, limit=1)
+        if not page:
+            break
+        seen += page
+        after = float(page[-1]["timestamp"])
+    assert len(seen) == 9
@@ -0,0 +1,670 @@
+import json
+import asyncio
+import socket
+import threading
+import time
+import pytest # type: ignore
+import server
+import ds_protocol
+from ds_protocol import compress_frame, decompress_frame
+from server import DSUServer, DSUCluster, ClientConnection, FrameBuffer, BinaryFrameBuffer, FrameTooLargeError
+from ds_bus import BusHub
+from ds_messenger import DirectMessenger
+
+@pytest.fixture
+def srv(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "DEBUG", False)
+    s = DSUServer("127.0.0.1", 0, store_dir=str(tmp_path / "store"))
+    s._create_storage_system()
+    yield s
+    s.store.close()
+
+def request(srv, conn, payload):
+    raw = srv.handle_request(json.dumps(payload), conn)
+    assert raw.endswith(b"\r\n")
+    return json.loads(raw)["response"]
+
+def login(srv, user, pw="pw"):
+    conn = ClientConnection(("127.0.0.1", 0))
+    resp = request(srv, conn, {"authenticate": {"username": user, "password": pw}})
+    assert resp["type"] == "ok"
+    return conn, resp["token"]
+
+def test_authenticate_new_and_returning(srv):
+    conn, token = login(srv, "alice")
+    assert conn.token == token
+    assert srv.sessions.user_for(token, conn) == "alice"
+    other = ClientConnection(("127.0.0.1", 1))
+    resp = request(srv, other, {"authenticate": {"username": "alice", "password": "bad"}})
+    assert resp["type"] == "error"
+    assert other.token is None
+
+def test_send_and_fetch(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    dm = {"entry": "hi", "recipient": "bob", "timestamp": "1"}
+    assert request(srv, a, {"token": ta, "directmessage": dm})["type"] == "ok"
+    resp = request(srv, b, {"token": tb, "fetch": "unread"})
+    assert [m["message"] for m in resp["messages"]] == ["hi"]
+    assert request(srv, b, {"token": tb, "fetch": "unread"})["messages"] == []
+
+def test_token_bound_to_connection(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    resp = request(srv, b, {"token": ta, "fetch": "all"})
+    assert resp == {"type": "error", "message": "Invalid user token."}
+
+def test_invalid_json(srv):
+    conn = ClientConnection(("127.0.0.1", 0))
+    resp = json.loads(srv.handle_request("}{", conn))["response"]
+    assert resp == {"type": "error", "message": "Incorrectly formatted JSON message."}
+
+def test_async_server_round_trip(srv):
+    async def scenario():
+        listener = await asyncio.start_server(srv.handle_async_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        auth = {"authenticate": {"username": "carol", "password": "pw"}}
+        writer.write(json.dumps(auth).encode() + b"\r\n")
+        line = await reader.readline()
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+        return json.loads(line)["response"]
+    resp = asyncio.run(scenario())
+    assert resp["type"] == "ok" and resp["token"]
+
+def test_async_push_is_written_on_the_loop(srv):
+    async def scenario():
+        listener = await asyncio.start_server(srv.handle_async_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        async def command(writer, reader, payload):
+            writer.write(json.dumps(payload).encode() + b"\r\n")
+            return json.loads(await reader.readline())["response"]
+        clients = {}
+        for user in ("bob", "alice"):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            token = (await command(writer, reader, {"authenticate": {"username": user, "password": "pw"}}))["token"]
+            clients[user] = (writer, reader, token)
+        bw, br, bt = clients["bob"]
+        assert (await command(bw, br, {"token": bt, "subscribe": True}))["type"] == "ok"
+        aw, ar, at = clients["alice"]
+        dm = {"entry": "hi", "recipient": "bob", "timestamp": "1"}
+        assert (await command(aw, ar, {"token": at, "directmessage": dm}))["type"] == "ok"
+        push = json.loads(await br.readline())["response"]
+        threads = [t.name for t in threading.enumerate()]
+        for _ in range(100):  # marked read once written, off the loop
+            if not srv.store.read_unread("bob", mark=False):
+                break
+            await asyncio.sleep(0.01)
+        unread = srv.store.read_unread("bob", mark=False)
+        for writer, _, _ in clients.values():
+            writer.close()
+        listener.close()
+        await listener.wait_closed()
+        return push, threads, unread
+    push, threads, unread = asyncio.run(scenario())
+    assert push["type"] == "push" and [m["message"] for m in push["messages"]] == ["hi"]
+    assert not any("_push_loop" in name for name in threads)  # no thread per subscriber
+    assert unread == []
+
+@pytest.mark.parametrize("policy", ["queue", "reject"])
+def test_async_admission(srv, policy):
+    srv.max_connections, srv.overload_policy, srv.queue_timeout = 1, policy, 0.2
+    async def scenario():
+        listener = await asyncio.start_server(srv.handle_async_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        auth = json.dumps({"authenticate": {"username": "carol", "password": "pw"}}).encode() + b"\r\n"
+        first_reader, first = await asyncio.open_connection("127.0.0.1", port)
+        first.write(auth)
+        await first_reader.readline()
+        # the server is full: turned away, at once or after queue_timeout
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        busy = json.loads(await reader.readline())["response"]
+        writer.close()
+        admitted = None
+        if policy == "queue":  # a queued client gets in once another one leaves
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await asyncio.sleep(0.05)
+            first.close()
+            writer.write(auth)
+            admitted = json.loads(await reader.readline())["response"]
+            writer.close()
+        first.close()
+        listener.close()
+        await listener.wait_closed()
+        return busy, admitted
+    busy, admitted = asyncio.run(scenario())
+    assert busy["type"] == "error" and "busy" in busy["message"]
+    if policy == "queue":
+        assert admitted["type"] == "ok"
+        assert srv.connection_stats == {"accepted": 3, "queued": 2, "rejected": 0, "timed_out": 1}
+    else:
+        assert srv.connection_stats == {"accepted": 1, "queued": 0, "rejected": 1, "timed_out": 0}
+
+def test_frame_buffer_partial_and_pipelined():
+    frames = FrameBuffer(max_frame_size=64)
+    assert frames.feed(b'{"a"') == []
+    assert frames.feed(b': 1}\r\n{"b": 2}\r\n{"c"') == [b'{"a": 1}', b'{"b": 2}']
+    assert frames.feed(b': 3}\r\n') == [b'{"c": 3}']
+
+def test_frame_buffer_max_size():
+    frames = FrameBuffer(max_frame_size=8)
+    with pytest.raises(FrameTooLargeError):
+        frames.feed(b"x" * 9)
+
+def test_pipelined_requests_answered_in_order(srv):
+    conn = ClientConnection(("127.0.0.1", 0))
+    auth = json.dumps({"authenticate": {"username": "dave", "password": "pw"}}).encode()
+    raw = srv.handle_frames([auth, b"", b"}{"], conn)
+    lines = raw.split(b"\r\n")
+    assert len(lines) == 3 and lines[2] == b""
+    assert json.loads(lines[0])["response"]["type"] == "ok"
+    assert json.loads(lines[1])["response"]["type"] == "error"
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = b""
+        self.closed = False
+    def sendall(self, data):
+        self.sent += data
+    def close(self):
+        self.closed = True
+
+def test_admission_queue_policy(tmp_path):
+    s = DSUServer(store_dir=str(tmp_path), workers=1, max_connections=2)
+    first, second, third = FakeSocket(), FakeSocket(), FakeSocket()
+    s._admit(first, "a")
+    s._admit(second, "b")
+    s._admit(third, "c")
+    assert s.pending.qsize() == 2
+    assert s.connection_stats == {"accepted": 2, "queued": 1, "rejected": 1, "timed_out": 0}
+    assert third.closed and b"busy" in third.sent
+
+def test_admission_reject_policy(tmp_path):
+    s = DSUServer(store_dir=str(tmp_path), workers=1, overload_policy="reject")
+    first, second = FakeSocket(), FakeSocket()
+    s._admit(first, "a")
+    s._admit(second, "b")
+    assert s.connection_stats == {"accepted": 1, "queued": 0, "rejected": 1, "timed_out": 0}
+    assert not first.closed and second.closed
+
+def test_default_workers_cover_every_connection(tmp_path):
+    # a persistent client holds its worker, so anything less would strand clients max_connections allows
+    assert DSUServer(store_dir=str(tmp_path)).workers == server.MAX_CONNECTIONS
+    assert DSUServer(store_dir=str(tmp_path), max_connections=500).workers == 500
+
+def test_admission_queue_timeout(tmp_path):
+    s = DSUServer(store_dir=str(tmp_path), workers=1, queue_timeout=0.05)
+    first, second = FakeSocket(), FakeSocket()
+    s._admit(first, "a")
+    s._admit(second, "b")
+    _wait_for(lambda: second.closed)
+    assert b"busy" in second.sent
+    assert s.connection_stats == {"accepted": 2, "queued": 1, "rejected": 0, "timed_out": 1}
+    assert s.open_connections == 1
+    # a worker skips the connection that timed out in the queue
+    s.pending.get()
+    connection, address, claim = s.pending.get()
+    assert connection is second and not claim.acquire(blocking=False)
+
+def test_more_clients_than_workers(tmp_path):
+    s = DSUServer(port=0, store_dir=str(tmp_path), workers=2, queue_timeout=0.2)
+    thread = threading.Thread(target=s.start_server, daemon=True)
+    thread.start()
+    assert s.ready.wait(5)
+    address = f"127.0.0.1:{s.port}"
+    # each persistent client holds a worker for as long as it is connected
+    clients = [DirectMessenger(address, user, "pw") for user in ("alice", "bob")]
+    with socket.create_connection(("127.0.0.1", s.port), timeout=5) as extra:
+        reply = json.loads(extra.makefile("rb").readline())["response"]
+    assert reply["type"] == "error" and "busy" in reply["message"]
+    assert s.connection_stats["timed_out"] == 1
+    clients[0]._sock.shutdown(socket.SHUT_RDWR)  # a worker frees up, so the next client is served
+    _wait_for(lambda: s.open_connections == 1)
+    assert DirectMessenger(address, "carol", "pw").send("hi", "bob")
+    s.shutdown()
+    thread.join(5)
+
+def test_fetch_since(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    for text in ["one", "two"]:
+        dm = {"entry": text, "recipient": "bob", "timestamp": "0"}
+        request(srv, a, {"token": ta, "directmessage": dm})
+    first = request(srv, b, {"token": tb, "fetch": "all"})["messages"][0]
+    resp = request(srv, b, {"token": tb, "fetch": {"since": first["timestamp"]}})
+    assert [m["message"] for m in resp["messages"]] == ["two"]
+    bad = request(srv, b, {"token": tb, "fetch": {"since": "yesterday"}})
+    assert bad["type"] == "error"
+
+def test_subscribe_pushes_new_messages(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    pushed = []
+    b._send = pushed.append
+    dm = {"entry": "before", "recipient": "bob", "timestamp": "0"}
+    request(srv, a, {"token": ta, "directmessage": dm})
+    resp = request(srv, b, {"token": tb, "subscribe": True})
+    assert resp["type"] == "ok"
+    # what was unread at subscribe time is pushed at once
+    dm["entry"] = "after"
+    request(srv, a, {"token": ta, "directmessage": dm})
+    _wait_for(lambda: len(pushed) == 2 and not b.pushing)
+    frames = [json.loads(f)["response"] for f in pushed]
+    assert [f["type"] for f in frames] == ["push", "push"]
+    assert [f["messages"][0]["message"] for f in frames] == ["before", "after"]
+    # pushed messages count as read once they have been written
+    assert request(srv, b, {"token": tb, "fetch": "unread"})["messages"] == []
+    request(srv, b, {"token": tb, "subscribe": False})
+    request(srv, a, {"token": ta, "directmessage": dm})
+    assert len(pushed) == 2
+    assert srv.subscribers == {}
+
+def test_failed_push_leaves_messages_unread(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    attempts = []
+    def broken(data):
+        attempts.append(data)
+        raise ConnectionResetError("gone")
+    b._send = broken
+    request(srv, b, {"token": tb, "subscribe": True})
+    request(srv, a, {"token": ta, "directmessage": {"entry": "lost", "recipient": "bob", "timestamp": "1"}})
+    _wait_for(lambda: attempts)
+    request(srv, a, {"token": ta, "directmessage": {"entry": "later", "recipient": "bob", "timestamp": "2"}})
+    time.sleep(0.05)
+    assert len(attempts) == 1  # nothing more is written once a push failed
+    unread = request(srv, b, {"token": tb, "fetch": "unread"})["messages"]
+    assert [m["message"] for m in unread] == ["lost", "later"]
+
+def test_slow_subscriber_does_not_block_sender(srv):
+    a, ta = login(srv, "alice")
+    b, tb = login(srv, "bob")
+    release = threading.Event()
+    pushed = []
+    def slow(data):
+        release.wait(5)
+        pushed.append(json.loads(data)["response"])
+    b._send = slow
+    request(srv, b, {"token": tb, "subscribe": True})
+    for i, entry in enumerate(["one", "two"]):
+        dm = {"entry": entry, "recipient": "bob", "timestamp": str(i + 1)}
+        assert request(srv, a, {"token": ta, "directmessage": dm})["type"] == "ok"
+    assert pushed == []  # both sends returned while bob's first push is still being written
+    release.set()
+    _wait_for(lambda: not b.pushing)
+    assert [m["message"] for f in pushed for m in f["messages"]] == ["one", "two"]
+
+def test_metrics_admin_command(srv):
+    conn = ClientConnection(("127.0.0.1", 5))
+    assert request(srv, conn, {"admin": "profile-on"})["type"] == "ok"
+    a, ta = login(srv, "alice")
+    dm = {"entry": "hi", "recipient": "alice", "timestamp": "0"}
+    request(srv, a, {"token": ta, "directmessage": dm})
+    srv.handle_frames([b'{"token": "%s", "fetch": "all"}' % ta.encode()], a)
+    resp = request(srv, conn, {"admin": "metrics"})
+    metrics = resp["metrics"]
+    assert metrics["enabled"] is True
+    assert metrics["commands"]["directmessage"]["count"] == 1
+    assert metrics["commands"]["fetch"]["count"] == 1
+    assert metrics["lock_wait"]["count"] > 0
+    assert metrics["bytes_out"] > 0
+    assert metrics["sessions"] == 1
+    request(srv, conn, {"admin": "profile-off"})
+    assert srv.store.lock_observer is None
+
+def test_admin_only_from_localhost(srv):
+    conn = ClientConnection(("10.0.0.8", 5))
+    resp = request(srv, conn, {"admin": "metrics"})
+    assert resp["type"] == "error" and "metrics" not in resp
+
+def test_resume_rebinds_session(srv):
+    a, token = login(srv, "alice")
+    srv._end_session(a)  # connection closed
+    b = ClientConnection(("127.0.0.1", 2))
+    resp = request(srv, b, {"resume": {"token": token}})
+    assert resp["type"] == "ok" and resp["token"] == token
+    assert request(srv, b, {"token": token, "fetch": "all"})["type"] == "ok"
+    # a third connection steals the session from a live one
+    c = ClientConnection(("127.0.0.1", 3))
+    assert request(srv, c, {"resume": {"token": token}})["type"] == "ok"
+    assert request(srv, b, {"token": token, "fetch": "all"})["type"] == "error"
+    # closing the old connection does not detach the moved session
+    srv._end_session(b)
+    assert srv.sessions.user_for(token, c) == "alice"
+    bad = request(srv, ClientConnection(("127.0.0.1", 4)), {"resume": {"token": "nope"}})
+    assert bad["type"] == "error"
+
+def test_detached_sessions_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    store = server.SessionStore(ttl=10, max_detached=2)
+    conns = [ClientConnection(("127.0.0.1", i)) for i in range(4)]
+    tokens = [store.create("u%d" % i, c) for i, c in enumerate(conns)]
+    store.release(tokens[0], conns[0])
+    now[0] += 11
+    store.release(tokens[1], conns[1])
+    assert len(store) == 3  # the first expired
+    assert store.resume(tokens[0], conns[0]) == (None, None)
+    store.release(tokens[2], conns[2])
+    store.release(tokens[3], conns[3])
+    assert len(store) == 2  # least recently detached dropped past the cap
+    assert store.resume(tokens[1], conns[0]) == (None, None)
+    assert store.resume(tokens[3], conns[0]) == ("u3", None)
+
+def test_session_released_when_handler_fails(srv):
+    class BrokenSocket(FakeSocket):
+        def recv(self, n):
+            raise OSError("reset")
+    conn_holder = []
+    real = srv._end_session
+    srv._end_session = lambda conn: (conn_holder.append(conn), real(conn))
+    srv.handle_client(BrokenSocket(), ("127.0.0.1", 9))
+    assert len(conn_holder) == 1
+
+def _fill_mailbox(srv, count):
+    srv.store.create_user("alice", "pw")
+    srv.store.create_user("bob", "pw")
+    for i in range(1, count + 1):
+        srv.store.add_message(str(i), "alice", "bob", str(float(i)))
+
+def test_paged_fetch(srv):
+    _fill_mailbox(srv, 10)
+    b, tb = login(srv, "bob")
+    resp = request(srv, b, {"token": tb, "fetch": {"after": "4", "limit": 2}})
+    assert [m["message"] for m in resp["messages"]] == ["5", "6"]
+    resp = request(srv, b, {"token": tb, "fetch": {"before": "4", "limit": 2}})
+    assert [m["message"] for m in resp["messages"]] == ["2", "3"]
+    for bad in [{"limit": 0}, {"limit": "2"}, {"after": "x"}, {"stream": 1}, {"page": 1}]:
+        assert request(srv, b, {"token": tb, "fetch": bad})["type"] == "error"
+
+def test_streamed_fetch(srv, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_CHUNK", 4)
+    _fill_mailbox(srv, 10)
+    b, tb = login(srv, "bob")
+    sent = []
+    b._send = sent.append
+    stream = json.dumps({"token": tb, "fetch": {"after": "1", "stream": True}}).encode()
+    before = json.dumps({"token": tb, "fetch": {"limit": 1}}).encode()
+    rest = srv.handle_frames([before, stream, before], b)
+    frames = [json.loads(line)["response"] for line in b"".join(sent).splitlines()]
+    # the response to the request before the stream is written first
+    assert [f["type"] for f in frames] == ["ok", "chunk", "chunk", "chunk", "end"]
+    assert [len(f["messages"]) for f in frames[1:4]] == [4, 4, 1]
+    assert [m["message"] for f in frames[1:4] for m in f["messages"]] == [str(i) for i in range(2, 11)]
+    assert json.loads(rest)["response"]["messages"][0]["message"] == "1"
+
+def test_streamed_fetch_limit(srv, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_CHUNK", 4)
+    _fill_mailbox(srv, 10)
+    b, tb = login(srv, "bob")
+    frames = list(srv.handle_request(json.dumps({"token": tb, "fetch": {"before": "9", "limit": 5, "stream": True}}), b))
+    chunks = [json.loads(f)["response"] for f in frames]
+    assert [m["message"] for c in chunks[:-1] for m in c["messages"]] == ["1", "2", "3", "4", "5"]
+    assert chunks[-1]["type"] == "end"
+
+def test_compression_negotiated_in_authenticate(srv):
+    _fill_mailbox(srv, 100)
+    b = ClientConnection(("127.0.0.1", 0))
+    auth = {"authenticate": {"username": "bob", "password": "pw", "compress": "zlib"}}
+    resp = request(srv, b, auth)
+    assert resp["compress"] == "zlib" and b.compress
+    token = resp["token"]
+    raw = srv.handle_request(json.dumps({"token": token, "fetch": "all"}), b)
+    assert raw.startswith(b'{"z": ') and raw.endswith(b"\r\n")
+    assert len(json.loads(decompress_frame(raw.strip().decode()))["response"]["messages"]) == 100
+    # small frames stay plain, and compressed requests are understood
+    dm = {"token": token, "directmessage": {"entry": "x" * 2000, "recipient": "alice", "timestamp": "0"}}
+    raw = srv.handle_request(compress_frame(json.dumps(dm).encode()).decode(), b)
+    assert json.loads(raw)["response"]["type"] == "ok"
+    # a client that does not ask gets plain frames
+    a, ta = login(srv, "alice")
+    assert not a.compress
+    assert srv.handle_request(json.dumps({"token": ta, "fetch": "all"}), a).startswith(b'{"response"')
+
+def test_binary_frame_buffer():
+    frames = FrameBuffer(max_frame_size=64)
+    assert frames.feed(b'{"a": 1}\r\n\x00\x00') == [b'{"a": 1}']
+    binary = frames.switch_to_binary()
+    assert binary.feed(b"\x00\x02h") == []
+    assert binary.feed(b"i\x00\x00\x00\x00\x00\x00\x00\x01x") == [b"hi", b"", b"x"]
+    with pytest.raises(FrameTooLargeError):
+        binary.feed(b"\x00\x00\x01\x00")
+
+def _unpack_frames(data):
+    frames = BinaryFrameBuffer().feed(data)
+    return [ds_protocol.unpack_response(f) for f in frames]
+
+def test_binary_encoding_negotiated(srv, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_CHUNK", 2)
+    _fill_mailbox(srv, 3)
+    b = ClientConnection(("127.0.0.1", 0))
+    auth = {"authenticate": {"username": "bob", "password": "pw", "encoding": "binary", "compress": "zlib"}}
+    resp = request(srv, b, auth)
+    assert resp["encoding"] == "binary" and "compress" not in resp
+    assert b.binary and not b.compress
+    token = resp["token"]
+    requests = [ds_protocol.pack_fetch(token, "unread")[4:],
+                ds_protocol.pack_directmessage(token, "yo", "alice", 0)[4:],
+                b"\x63junk"]
+    replies = _unpack_frames(srv.handle_frames(requests, b, binary=True))
+    assert [m["message"] for m in replies[0].messages] == ["1", "2", "3"]
+    assert replies[1].type == "ok"
+    assert replies[2].type == "error"
+    # a binary stream, and a binary push
+    sent = []
+    b._send = sent.append
+    stream = ds_protocol.pack_fetch_page(token, stream=True)[4:]
+    srv.handle_frames([stream], b, binary=True)
+    assert [r.type for r in _unpack_frames(b"".join(sent))] == ["chunk", "chunk", "end"]
+    sent.clear()
+    srv.handle_frames([ds_protocol.pack_subscribe(token)[4:]], b, binary=True)
+    srv.store.add_message("pushed", "alice", "bob")
+    srv._push_new_messages("bob")
+    _wait_for(lambda: not b.pushing)
+    pushes = _unpack_frames(b"".join(sent))
+    assert pushes[-1].type == "push" and pushes[-1].messages[0]["message"] == "pushed"
+
+def test_search(srv):
+    _fill_mailbox(srv, 3)
+    srv.store.add_message("lunch tomorrow?", "alice", "bob", "4.0")
+    srv.store.add_message("Lunch is on me", "bob", "alice", "5.0")
+    b, tb = login(srv, "bob")
+    resp = request(srv, b, {"token": tb, "search": {"query": "lunch"}})
+    assert resp["type"] == "ok"
+    assert resp["messages"] == [{"from": "alice", "message": "lunch tomorrow?", "timestamp": "4.0"},
+                                {"recipient": "alice", "message": "Lunch is on me", "timestamp": "5.0"}]
+    resp = request(srv, b, {"token": tb, "search": {"query": "lunch", "contact": "alice", "after": "4", "limit": 1}})
+    assert [m["message"] for m in resp["messages"]] == ["Lunch is on me"]
+    for bad in ["lunch", {"query": ""}, {"query": "x", "limit": 0}, {"query": "x", "contact": 1}, {"query": "x", "page": 1}]:
+        assert request(srv, b, {"token": tb, "search": bad})["type"] == "error"
+    assert request(srv, b, {"token": "nope", "search": {"query": "lunch"}})["type"] == "error"
+
+def test_remote_sessions(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    store = server.SessionStore(ttl=10)
+    here = ClientConnection(("127.0.0.1", 1))
+    token = store.create("alice", here)
+    # resumed in another worker process: the connection here loses it
+    assert store.bind_remote(token, "alice") is here
+    assert store.user_for(token, here) is None
+    assert not store.release(token, here)
+    # a session started elsewhere can be resumed here once detached there
+    store.bind_remote("t2", "bob")
+    store.release_remote("t2", "bob")
+    assert store.resume("t2", here) == ("bob", None)
+    store.release_remote("t2", "bob")  # late news of the old connection closing
+    assert store.user_for("t2", here) == "bob"
+    store.release_remote(token, "alice")
+    now[0] += 11
+    assert store.resume(token, here) == (None, None)
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    '''Two DSUServers sharing one sqlite store and a bus, as the worker processes of a DSUCluster do'''
+    monkeypatch.setattr(server, "DEBUG", False)
+    hub = BusHub(str(tmp_path / "bus.sock"))
+    hub.start()
+    pair = [DSUServer("127.0.0.1", 0, store_dir=str(tmp_path / "store"), backend="sqlite", bus_path=hub.path)
+            for _ in range(2)]
+    for w in pair:
+        w._create_storage_system()
+    yield pair
+    for w in pair:
+        w._close_storage_system()
+    hub.close()
+
+def test_push_reaches_subscriber_on_other_worker(workers):
+    w1, w2 = workers
+    a, ta = login(w1, "alice")
+    b, tb = login(w2, "bob")
+    b2, tb2 = login(w1, "bob")
+    sent = {b: [], b2: []}
+    for conn in sent:
+        conn._send = sent[conn].append
+    request(w2, b, {"token": tb, "subscribe": True})
+    request(w1, b2, {"token": tb2, "subscribe": True})
+    dm = {"token": ta, "directmessage": {"entry": "hi", "recipient": "bob", "timestamp": "1"}}
+    assert request(w1, a, dm)["type"] == "ok"
+    _wait_for(lambda: sent[b] and sent[b2] and not b.pushing and not b2.pushing)
+    for conn in (b, b2):  # both subscriptions get it, once
+        assert [m["message"] for m in json.loads(sent[conn][0])["response"]["messages"]] == ["hi"]
+    assert request(w2, b, {"token": tb, "fetch": "unread"})["messages"] == []
+
+def test_resume_on_other_worker(workers):
+    w1, w2 = workers
+    a, token = login(w1, "alice")
+    _wait_for(lambda: w2.sessions.user_of(token) == "alice")
+    w1._end_session(a)
+    _wait_for(lambda: token in w2.sessions._detached)
+    b = ClientConnection(("127.0.0.1", 2))
+    assert request(w2, b, {"resume": {"token": token}})["type"] == "ok"
+    _wait_for(lambda: w1.sessions._sessions[token].conn is server.REMOTE)
+    assert request(w1, ClientConnection(("127.0.0.1", 3)), {"resume": {"token": token}})["type"] == "ok"
+
+def test_cluster_needs_process_safe_backend(tmp_path):
+    with pytest.raises(ValueError):
+        DSUCluster("127.0.0.1", 0, 2, store_dir=str(tmp_path), backend="json")
+
+def test_cluster(tmp_path):
+    cluster = DSUCluster("127.0.0.1", 0, 2, store_dir=str(tmp_path / "store"))
+    thread = threading.Thread(target=cluster.start_server, daemon=True)
+    thread.start()
+    assert cluster.ready.wait(30)
+    assert len({w.pid for w in cluster.workers}) == 2
+    address = f"127.0.0.1:{cluster.port}"
+    bob = DirectMessenger(address, "bob", "pw")
+    assert bob.subscribe()
+    alice = DirectMessenger(address, "alice", "pw")
+    assert alice.send("hello", "bob")
+    _wait_for(lambda: bob._pushed.qsize())
+    assert [m.message for m in bob.retrieve_pushed()] == ["hello"]
+    assert bob.reconnect()
+    cluster.shutdown()
+    thread.join(30)
+    assert not cluster.workers
+
+def test_group_directmessage(srv):
+    for user in ("bob", "carol"):
+        login(srv, user)
+    a, ta = login(srv, "alice")
+    dm = {"token": ta, "directmessage": {"entry": "hi all", "recipient": ["bob", "carol"], "timestamp": "0"}}
+    assert request(srv, a, dm)["type"] == "ok"
+    assert [m["message"] for m in srv.store.read_unread("carol")] == ["hi all"]
+    for bad in [[], ["bob", 7], ["bob"] * (server.MAX_RECIPIENTS + 1)]:
+        dm["directmessage"]["recipient"] = bad
+        assert request(srv, a, dm)["type"] == "error"
+    dm["directmessage"]["recipient"] = ["bob", "nobody"]
+    assert request(srv, a, dm)["type"] == "error"
+    assert srv.store.read_unread("bob") == [{"from": "alice", "message": "hi all", "timestamp": srv.store.read_all("alice")[0]["timestamp"]}]
+
+def test_directmessage_rejects_non_string_fields(srv):
+    login(srv, "bob")
+    a, ta = login(srv, "alice")
+    for bad in [{"entry": 123, "recipient": "bob"}, {"entry": ["hi"], "recipient": ["bob"]},
+                {"entry": "hi", "recipient": 7}, {"entry": "hi", "recipient": {"bob": 1}}]:
+        dm = {"token": ta, "directmessage": dict(bad, timestamp="1")}
+        assert request(srv, a, dm)["type"] == "error"
+    assert srv.store.read_all("alice") == []
+
+def test_directmessage_message_id(srv):
+    login(srv, "bob")
+    a, ta = login(srv, "alice")
+    dm = {"token": ta, "directmessage": {"entry": "once", "recipient": "bob", "timestamp": "0", "message_id": "m1"}}
+    # a retried send is acknowledged but stored once
+    assert request(srv, a, dm)["type"] == "ok"
+    assert request(srv, a, dm)["type"] == "ok"
+    assert [m["message"] for m in srv.store.read_unread("bob")] == ["once"]
+    for bad in ["", 7, "x" * (server.MAX_MESSAGE_ID + 1)]:
+        dm["directmessage"]["message_id"] = bad
+        assert request(srv, a, dm)["type"] == "error"
+    dm["directmessage"]["message_id"] = "m2"
+    dm["directmessage"]["extra"] = 1
+    assert request(srv, a, dm)["type"] == "error"
+    assert len(srv.store.read_all("alice")) == 1
+
+def test_retention_needs_an_archive(tmp_path):
+    with pytest.raises(ValueError):
+        DSUServer("127.0.0.1", 0, store_dir=str(tmp_path), backend="sqlite", retention_days=30)
+    s = DSUServer("127.0.0.1", 0, store_dir=str(tmp_path), retention_days=30)
+    assert s.store.retention_days == 30
+
+def test_memory_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "DEBUG", False)
+    with pytest.raises(ValueError):
+        DSUServer("127.0.0.1", 0, store_dir=str(tmp_path), snapshot=True)
+    s = DSUServer("127.0.0.1", 0, store_dir=str(tmp_path / "store"), backend="memory")
+    s._create_storage_system()
+    login(s, "bob")
+    a, ta = login(s, "alice")
+    dm = {"token": ta, "directmessage": {"entry": "hi", "recipient": "bob", "timestamp": "0"}}
+    assert request(s, a, dm)["type"] == "ok"
+    assert [m["message"] for m in s.store.read_unread("bob")] == ["hi"]
+    s._close_storage_system()
+    assert not (tmp_path / "store").exists()
+
+def test_authenticate_lost_create_race(srv):
+    login(srv, "alice")
+    # the lookup misses, as when another client creates the user just after it
+    real = srv.store.get_password
+    misses = [None]
+    srv.store.get_password = lambda user: misses.pop() if misses else real(user)
+    conn = ClientConnection(("127.0.0.1", 2))
+    resp = request(srv, conn, {"authenticate": {"username": "alice", "password": "WRONG"}})
+    assert resp["type"] == "error" and conn.token is None
+    misses.append(None)
+    conn, token = login(srv, "alice")
+    assert srv.sessions.user_for(token, conn) == "alice"
+
+def test_streamed_fetch_after_large_group_message(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "DEBUG", False)
+    s = DSUServer("127.0.0.1", 0, store_dir=str(tmp_path), backend="memory")
+    s._create_storage_system()
+    recipients = [f"user{i}" for i in range(server.STREAM_CHUNK + 100)]
+    for user in recipients:
+        s.store.create_user(user, "pw")
+    a, ta = login(s, "alice")
+    dm = {"token": ta, "directmessage": {"entry": "hi all", "recipient": recipients, "timestamp": "0"}}
+    assert request(s, a, dm)["type"] == "ok"
+    frames = [json.loads(f)["response"] for f in s.handle_request(json.dumps({"token": ta, "fetch": {"stream": True}}), a)]
+    streamed = [m["recipient"] for f in frames if f["type"] == "chunk" for m in f["messages"]]
+    assert streamed == recipients
+    s._close_storage_system()
+
+def test_streamed_fetch_of_messages_to_self(srv, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_CHUNK", 1)
+    a, ta = login(srv, "alice")
+    for i in range(3):
+        dm = {"token": ta, "directmessage": {"entry": f"note {i}", "recipient": "alice", "timestamp": "0"}}
+        assert request(srv, a, dm)["type"] == "ok"
+    frames = [json.loads(f)["response"] for f in srv.handle_request(json.dumps({"token": ta, "fetch": {"stream": True}}), a)]
+    streamed = [m for f in frames if f["type"] == "chunk" for m in f["messages"]]
+    assert len(streamed) == 6